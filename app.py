@@ -1,61 +1,212 @@
-import json
+import threading
+import time
+import requests
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
-from gpt_api import GPT_API
+from streamlit.errors import StreamlitAPIException
+from firebase_admin import firestore, auth
+from google.cloud.firestore_v1.field_path import FieldPath
+import auth_session
+import authors
+import bootstrap
+import counters
+import feeds
+import metrics
+from gpt_api import GPT_API, JSONFieldExtractor, parse_json
+from gpt_scheduler import GPTUnavailable
+from live_cache import LiveCollectionCache
+from message_thread import get_thread
+from search_index import SearchIndex
+from write_pipeline import WritePipeline
 from sign_in_with_email_and_password import sign_in_with_email_and_password
 from send_email_verification_link import send_email_verification_link
 
-
-# Securely connect to Firebase
-key_dict = json.loads(st.secrets["textkey"])
-if not firebase_admin._apps:
-    cred = credentials.Certificate(key_dict)
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
-batch = db.batch()
-
+rerun_start = time.perf_counter()
 
 # Set the default page config and load css
 st.set_page_config(
     layout="wide",
     page_title='IgniteMe.app'
 )
-
-with open('style.css') as f:
-    st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
-
+st.markdown(bootstrap.load_css(), unsafe_allow_html=True)
+
+# Securely connect to Firebase, once per process
+db = bootstrap.get_db()
+
+# Feed pagination
+FEED_PAGE_SIZE = 12
+FEED_CACHE_TTL = 60  # seconds, shared by all sessions
+# Feed orderings: the counter field sorted on, newest/highest first, with the
+# document id breaking ties. Posts without the field are left out of that
+# ordering until `python counters.py backfill` has run.
+FEED_ORDERS = {'Default': None, 'Recently active': 'last_activity_at',
+               'Most discussed': 'message_count'}
+# Feed tabs; the personal ones read the lists feeds.py keeps per user
+FEED_TABS = {'For You': None, 'Following': 'feed', 'Your Posts': 'timeline'}
 
 # Initialise session state variables
-session_states = ['goal_input', 'message_input', "answer_input",
-                  'gpt_coach', 'gpt_response',
-                  'user_info', 'post', 'obstacle']
-for state in session_states:
-    if state not in st.session_state:
-        st.session_state[state] = ""
-
-session_states = ['toggle_post', 'toggle_dialog',
-                  'toggle_gpt', 'toggle_login', 'toggle_signup']
-for state in session_states:
-    if state not in st.session_state:
-        st.session_state[state] = False
+bootstrap.init_session_state()
+bootstrap.check_budget(rerun_start)
+bootstrap.start_metrics_server()
+metrics.begin_run(st.session_state['perf'])
 
 # Define Components
 
 
-def update_firebase(collection, data):
-    doc_ref = db.collection(collection).document()
-    doc_ref.set(data)
+@st.cache_resource
+def get_live_cache():
+    return LiveCollectionCache(db)
+
+
+@st.cache_resource
+def get_search_index():
+    # Warm start from disk, then catch up with Firestore in the background
+    index = SearchIndex.load()
+    threading.Thread(target=index.sync, args=(db, ), daemon=True).start()
+    return index
+
+
+@st.cache_resource
+def get_author_cache():
+    return authors.AuthorCache(db)
+
+
+def author_names(docs):
+    # Display name for each document's author, with one batched read for
+    # any authors this process hasn't looked up recently
+    profiles = get_author_cache().lookup(
+        {doc['author'] for doc in docs if 'author' in doc})
+    return [authors.display_name(doc, profiles) for doc in docs]
+
+
+@st.cache_resource
+def get_write_pipeline():
+    return WritePipeline(db)
+
+
+def submit_writes(writes, on_commit=None, kind="write"):
+    write_id = get_write_pipeline().submit(writes, on_commit, kind)
+    st.session_state['pending_writes'].append(write_id)
+    return write_id
+
+
+def collect_write_acks():
+    # Move finished background commits from the pipeline into session state
+    pending = st.session_state['pending_writes']
+    if not pending:
+        return
+    acks = get_write_pipeline().collect(pending)
+    st.session_state['pending_writes'] = [
+        w for w in pending if w not in acks]
+    st.session_state['write_acks'].update(acks)
+    for write_id, ack in acks.items():
+        # Messages are shown as soon as they're sent, take back the failed ones
+        message = st.session_state['pending_messages'].pop(write_id, None)
+        if ack['status'] == 'failed':
+            if message is not None:
+                collection, doc_id = message
+                get_thread(st.session_state['threads'], collection).drop_pending(doc_id)
+            st.error('Saving failed, please try again. ' + ack['error'])
 
 
 def stream_firebase(collection, limit=False):
+    if not limit:
+        # Whole collections are served from the shared listener cache
+        with metrics.timed('firestore_read_seconds', source='listener'):
+            docs = get_live_cache().stream(collection)
+        metrics.inc('firestore_documents_served_total', len(docs), source='listener')
+        return docs
     post_refs = db.collection(collection)
     if limit:
         post_refs = post_refs.limit(limit)
-    docs = post_refs.stream()
+    with metrics.timed('firestore_read_seconds', source='query'):
+        docs = list(post_refs.stream())
+    metrics.inc('firestore_documents_read_total', len(docs), source='query')
     return docs
 
 
+@st.cache_data(ttl=FEED_CACHE_TTL, show_spinner=False)
+def fetch_posts_page(page_size, start_after=None, order='Default'):
+    # One page of the feed, continued from the (value, id) of the last post
+    # on the previous page. Counters live on the posts, so this is a single
+    # query however the feed is ordered.
+    doc_id = FieldPath.document_id()
+    field = FEED_ORDERS[order]
+    if field is None:
+        query = db.collection('posts').order_by(doc_id).limit(page_size)
+    else:
+        query = db.collection('posts').order_by(
+            field, direction=firestore.Query.DESCENDING).order_by(
+            doc_id, direction=firestore.Query.DESCENDING).limit(page_size)
+    if start_after:
+        value, last_id = start_after
+        cursor = {doc_id: last_id}
+        if field is not None:
+            cursor[field] = value
+        query = query.start_after(cursor)
+    posts = []
+    with metrics.timed('firestore_read_seconds', source='feed'):
+        for doc in query.stream():
+            post = doc.to_dict()
+            post['id'] = doc.id
+            posts.append(post)
+    metrics.inc('firestore_documents_read_total', len(posts), source='feed')
+    return posts
+
+
+@st.cache_data(ttl=FEED_CACHE_TTL, show_spinner=False)
+def fetch_feed_page(uid, kind, page_size, start_after=None):
+    return feeds.page(db, uid, kind, page_size, start_after)
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_following(uid):
+    return set(feeds.following(db, uid))
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_counter_shards(path):
+    # Read from the document itself: the post in session state may have come
+    # from search results, which don't carry counter_shards
+    with metrics.timed('firestore_read_seconds', source='counter_shards'):
+        shards = counters.shard_count(db.document(path))
+    metrics.inc('firestore_documents_read_total', source='counter_shards')
+    return shards
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_user_profile(uid):
+    with metrics.timed('firestore_read_seconds', source='profile'):
+        user_info = db.collection('users').document(uid).get().to_dict()
+    metrics.inc('firestore_documents_read_total', source='profile')
+    if 'user_name' in user_info.keys():  # todo: remove this
+        user_info['display_name'] = user_info['user_name']
+    user_info.pop('password', None)  # stored by signups before authors.migrate
+    return dict(user_info, uid=uid)
+
+
+def resume_session():
+    # Sign a returning browser back in from the tokens kept for the sid in
+    # its auth cookie, never from anything in the URL
+    sid = auth_session.cookie_sid()
+    if st.session_state['user_info'] or not bootstrap.valid_sid(sid):
+        return
+    try:
+        claims = auth_session.resume(sid)
+    except requests.RequestException:
+        return
+    if claims:
+        st.session_state['user_info'] = get_user_profile(claims['uid'])
+        st.session_state['auth_sid'] = sid
+
+
+def sign_in(login_res):
+    # Tokens go under a new auth sid, which the browser keeps in a cookie
+    if st.session_state['auth_sid']:
+        auth_session.forget(st.session_state['auth_sid'])
+    sid = auth_session.save(login_res)
+    st.session_state['auth_sid'] = st.session_state['auth_cookie'] = sid
+
+
 def login():
     st.session_state['toggle_login'] = False
     auth_info = {'email': st.session_state['email_input'],
@@ -64,13 +215,12 @@ def login():
         # user = auth.get_user_by_email(auth_info['email'])
         login_res = sign_in_with_email_and_password(**auth_info)
         if 'registered' in login_res.keys():
-            user_ref = db.collection('users').document(login_res['localId'])
-            auth_info = user_ref.get().to_dict()
-
-            if 'user_name' in auth_info.keys():  # todo: remove this
-                auth_info['display_name'] = auth_info['user_name']
+            auth_info = get_user_profile(login_res['localId'])
             st.session_state['user_info'] = auth_info
-            st.success('Welcome back! ' + auth_info['display_name'])
+            sign_in(login_res)
+            bootstrap.rotate_session_id()
+            request_app_rerun()  # the feed tabs and follow buttons depend on who is signed in
+            notify('success', 'Welcome back! ' + auth_info['display_name'])
             st.session_state['toggle_login'] = False
             st.session_state['toggle_signup'] = False
             if st.session_state['gpt_response']:
@@ -79,11 +229,14 @@ def login():
             error_message = login_res['error']['message']
             st.session_state['user_info'] = ''
             if error_message == "INVALID_PASSWORD":
-                st.error(login_res['error']['message'])
+                notify('error', login_res['error']['message'])
             else:
                 st.session_state['toggle_signup'] = True
     except auth.UserNotFoundError:
         signup()
+    except requests.RequestException:
+        st.session_state['user_info'] = ''
+        notify('error', 'Sign in is unavailable right now. Please try again later.')
 
 
 def signup():
@@ -95,28 +248,32 @@ def signup():
         user = auth.create_user(**auth_info)
         # send_email_verification_link(auth_info['email'])
         # st.info('Please check your email to verify your account.')
+        # The password stays with Firebase Auth, never in Firestore
+        profile = {'email': auth_info['email'], 'display_name': auth_info['display_name']}
         user_ref = db.collection('users').document(user.uid)
-        user_ref.set(auth_info)
-        st.session_state['user_info'] = auth_info
+        user_ref.set(profile)
+        st.session_state['user_info'] = dict(profile, uid=user.uid)
+        bootstrap.rotate_session_id()
+        request_app_rerun()
 
-        st.success('Welcome! ' + auth_info['display_name'])
+        notify('success', 'Welcome! ' + auth_info['display_name'])
         st.session_state['toggle_login'] = False
         st.session_state['toggle_signup'] = False
         if st.session_state['gpt_response']:
             submit_goal()
     except auth.EmailAlreadyExistsError:
         st.session_state['user_info'] = ''
-        st.sidebar.error(
-            'Email already exists. Please try a different email.')
+        notify('error', 'Email already exists. Please try a different email.')
     except Exception as e:
         st.session_state['user_info'] = ''
-        st.sidebar.error(
-            'Account creation failed. Please try again later.')
-        st.write(e)
+        notify('error', f'Account creation failed. Please try again later. ({e})')
 
 
 def logout():
     st.session_state['user_info'] = ""
+    auth_session.forget(st.session_state['auth_sid'])
+    st.session_state['auth_sid'] = st.session_state['auth_cookie'] = ""
+    request_app_rerun()
 
 
 def open_dialog():
@@ -124,6 +281,44 @@ def open_dialog():
     st.session_state['goal_input'] = st.session_state['goal_input']
 
 
+# Reply formats for the coaching dialog, sent as functions the model is
+# forced to call, so replies are JSON arguments rather than free text
+CLARIFICATION_SCHEMA = {
+    "name": "clarify",
+    "description": "Ask the user one clarification question about their goal and obstacles.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "success": {"type": "boolean", "description": "Always false for this form."},
+            "response": {"type": "string",
+                         "description": "Your question or response, in one sentence."},
+        },
+        "required": ["success", "response"],
+    },
+}
+SUMMARY_SCHEMA = {
+    "name": "summarize",
+    "description": "Show the summary and ask for confirmation, or output it once confirmed.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "success": {"type": "boolean",
+                        "description": "True only after the user confirms the summary."},
+            "response": {"type": "string", "description": "Your question or response."},
+            "goal": {"type": "object", "description": "When success is true, the summary of the goal.",
+                     "properties": {"content": {"type": "string"}}, "required": ["content"]},
+            "obstacles": {"type": "array",
+                          "description": "When success is true, the summary of each obstacle.",
+                          "items": {"type": "object",
+                                    "properties": {"content": {"type": "string"}},
+                                    "required": ["content"]}},
+        },
+        "required": ["success", "response"],
+    },
+}
+REASK_PROMPT = "That reply wasn't valid JSON. Send the same reply again as one JSON object."
+
+
 def initial_dialog(goal):
     st.session_state['toggle_gpt'] = True
     obs = [st.session_state[o] for o in ['obs_1', 'obs_2', 'obs_3']]
@@ -135,29 +330,20 @@ def initial_dialog(goal):
         The goal is to help me structure my thoughts and be clear about the challenges I have. 
         Make sure the thought process is MECE (Mutually Exclusive, Collectively Exhaustive). 
         Ask one clarification question at a time.
-        
-        Response format (remove all spaces and indentations):
-        ```json
-        {
-            "success": false, # it has to be false for this form
-            "response": "put your questions or response here, in one sentence",
-        }
-        ```
         """
         user_input = f"My goal is: {goal}, but I can't because:{obs}"
-        st.info(user_input)
 
         # Initialize GPT
-        gpt_coach = GPT_API()
+        gpt_coach = GPT_API(user=bootstrap.session_id())
         st.session_state['gpt_coach'] = gpt_coach
 
-        gpt_response = gpt_coach.chat(user_input + clarification)
-        print(gpt_response)
-        gpt_response = json.loads(gpt_response)
-        st.session_state['gpt_response'] = gpt_response['response']
+        gpt_coach.instructions(clarification, CLARIFICATION_SCHEMA)
+
+        # The completion is streamed into the dialog by stream_gpt_response
+        st.session_state['gpt_pending'] = user_input
 
     else:
-        st.warning("Please fill all the fields")
+        notify('warning', "Please fill all the fields")
 
 
 def follow_up_form():
@@ -168,99 +354,282 @@ def follow_up_form():
         instructions = """
         If you've fully understood my goal and obstacles, show me the summary and ask me for confirmation.
         If I confirm, output the summary
-        
-        Response format (remove all spaces and indentations):
-        ```json
-        {
-            "success": false, # use true after I confirm the summary,
-            "response": "put your questions or response here"",
-            "goal": 
-                {"content: "goal"} # when success is true, output the summary of my goal"
-            "obstacles": [
-                {"content": "obstacles #1"}, # # when success is true, output the summary of obastacles in list
-                {"content": "obstacles #2"}
-                ...
-            ]
-        }
-        ```
         """
 
-        gpt_coach = st.session_state['gpt_coach']
-        gpt_response = gpt_coach.chat(answer + instructions)
-        st.session_state['gpt_coach'] = gpt_coach
+        st.session_state['gpt_coach'].instructions(instructions, SUMMARY_SCHEMA)
+        st.session_state['gpt_pending'] = answer
+
+    else:
+        notify('warning', "Please fill all the fields")
+
+
+def stream_gpt_response():
+    # Saved with the prompt still pending, so a session resumed after this
+    # process dies mid-stream asks again instead of losing the turn
+    bootstrap.persist_session()
+    prompt = st.session_state['gpt_pending']
+    st.session_state['gpt_pending'] = ""
+    gpt_coach = st.session_state['gpt_coach']
+
+    # Show the "response" field live while the rest of the JSON generates
+    st.info(prompt)
+    placeholder = st.empty()
+    extractor = JSONFieldExtractor("response")
+    chunks, shown = [], ""
+    try:
+        for token in gpt_coach.chat_stream(prompt, cache_if=is_cacheable_reply):
+            chunks.append(token)
+            shown += extractor.feed(token)
+            if shown:
+                placeholder.write(shown)
+    except GPTUnavailable:
+        # Queued or retried past the limit; the prompt wasn't kept
+        placeholder.error("The coach is very busy right now.")
+        st.button("Try again", key="gpt_retry", on_click=retry_gpt, args=(prompt, ))
+        return
+    st.session_state['gpt_coach'] = gpt_coach
+
+    gpt_response = "".join(chunks)
+    print(gpt_response)
+    gpt_response = parse_json(gpt_response)
+    if not is_coach_reply(gpt_response):
+        # Repair didn't help; ask once more before giving up on the turn
+        metrics.inc('gpt_reasks_total')
+        try:
+            gpt_response = parse_json(gpt_coach.chat(REASK_PROMPT, cache_if=is_cacheable_reply))
+        except GPTUnavailable:
+            gpt_response = None
+    if not is_coach_reply(gpt_response):
+        placeholder.error("The coach's reply didn't make sense. Please try again.")
+        st.button("Try again", key="gpt_retry", on_click=retry_gpt, args=(prompt, ))
+        return
+
+    if gpt_response['success'] and gpt_response.get('goal') and \
+            gpt_response.get('obstacles'):
+        st.session_state['gpt_response'] = gpt_response
+        st.session_state['toggle_dialog'] = False
+        st.session_state['toggle_gpt'] = False
+
+        if st.session_state['user_info']:
+            submit_goal()
+        else:
+            st.session_state['toggle_login'] = True
+    else:
+        st.session_state['gpt_response'] = gpt_response['response']
+        st.session_state['answer_input'] = ""
+    rerun_fragment()
 
-        print(gpt_response)
-        gpt_response = json.loads(gpt_response)
 
-        if gpt_response['success']:
-            st.session_state['gpt_response'] = gpt_response
-            st.session_state['toggle_dialog'] = False
-            st.session_state['toggle_gpt'] = False
+def retry_gpt(prompt):
+    st.session_state['gpt_pending'] = prompt
 
-            if st.session_state['user_info']:
-                submit_goal()
-            else:
-                st.session_state['toggle_login'] = True
-        else:
-            st.session_state['gpt_response'] = gpt_response['response']
-            st.session_state['answer_input'] = ""
 
-    else:
-        st.warning("Please fill all the fields")
+def is_coach_reply(reply):
+    # Function calling doesn't enforce required fields, so check them here
+    return isinstance(reply, dict) and isinstance(reply.get('response'), str) and \
+        isinstance(reply.get('success'), bool)
+
+
+def is_cacheable_reply(text):
+    # The cache is shared, so only replies the dialog accepts are stored,
+    # repaired ones included; a retry after a bad one asks again
+    return is_coach_reply(parse_json(text))
 
 
 def submit_goal():
     gpt_response = st.session_state['gpt_response']
-    gpt_response['goal']['user_info'] = st.session_state['user_info']
+    gpt_response['goal']['author'] = st.session_state['user_info']['uid']
+    gpt_response['goal']['created_at'] = firestore.SERVER_TIMESTAMP
+    # Engagement counters, kept up to date by submit_message
+    gpt_response['goal']['obstacle_count'] = len(gpt_response['obstacles'])
+    gpt_response['goal']['message_count'] = 0
+    gpt_response['goal']['last_activity_at'] = firestore.SERVER_TIMESTAMP
     user_ref = db.collection('posts').document()
-    batch.set(user_ref, gpt_response['goal'])
+    # The post lands in the author's own lists in the same batch, and in
+    # followers' feeds once it has committed
+    post_entry = feeds.entry(gpt_response['goal'])
+    writes = [(user_ref, gpt_response['goal'])] + \
+        feeds.own_writes(db, user_ref.id, post_entry)
     for obstacle_value in gpt_response['obstacles']:
         subcollection_ref = user_ref.collection(
             'obstacles').document()
-        batch.set(subcollection_ref, obstacle_value)
-    batch.commit()
+        writes.append((subcollection_ref, dict(obstacle_value, message_count=0)))
+
+    index = get_search_index()
+    text = "\n".join([gpt_response['goal']['content']] +
+                     [o['content'] for o in gpt_response['obstacles']])
+    card = {'content': gpt_response['goal']['content'],
+            'author': st.session_state['user_info']['uid'],
+            'display_name': st.session_state['user_info']['display_name']}
+
+    pipeline = get_write_pipeline()
+
+    def on_commit():
+        fetch_posts_page.clear()
+        fetch_feed_page.clear()
+        index.add(user_ref.id, text, **card)
+        index.maybe_save()
+        # Last, it reads the followers and can fail on its own
+        for fan_out_writes in feeds.fan_out(db, user_ref.id, post_entry):
+            pipeline.submit(fan_out_writes, kind='fanout')
+
+    submit_writes(writes, on_commit=on_commit, kind='goal')
     st.session_state['gpt_response'] = ""
 
 
 def submit_message(collection):
     if st.session_state['user_info']:
         data = {"content": st.session_state['message_input'],
-                "user_info": st.session_state['user_info']}
-        update_firebase(collection, data)
+                "author": st.session_state['user_info']['uid']}
+        doc_ref = db.collection(collection).document()
+        obstacle_ref = doc_ref.parent.parent
+        post_ref = obstacle_ref.parent.parent
+        # The message and both counters commit in one batch, so they can't
+        # disagree; Increment needs no read, so no transaction either
+        write_id = submit_writes(
+            [(doc_ref, dict(data, created_at=firestore.SERVER_TIMESTAMP)),
+             counters.increment(obstacle_ref, get_counter_shards(obstacle_ref.path)),
+             counters.increment(post_ref, get_counter_shards(post_ref.path))],
+            kind='message')
+        get_thread(st.session_state['threads'], collection).add_pending(
+            doc_ref.id, data)
+        st.session_state['pending_messages'][write_id] = (collection, doc_ref.id)
         st.session_state['message_input'] = ''
     else:
         st.session_state['toggle_login'] = True
-        st.warning("Please Sign In First")
+        request_app_rerun()  # the login form lives in the navbar
+        notify('warning', "Please Sign In First")
+
+
+def load_more_posts():
+    st.session_state['feed_pages'] += 1
+
+
+def reset_feed_pages():
+    st.session_state['feed_pages'] = 1
+
+
+def personal_feed(kind, n_cols, page_size=FEED_PAGE_SIZE):
+    # One ordered read per page of a list kept per user, however many posts
+    # exist overall
+    user_info = st.session_state['user_info']
+    if not user_info:
+        st.caption('Sign in to see the goals of people you follow and your own.')
+        return
+    posts = []
+    cursor = None
+    has_more = True
+    for _ in range(st.session_state['feed_pages']):
+        page = fetch_feed_page(user_info['uid'], kind, page_size, cursor)
+        posts.extend(page)
+        if len(page) < page_size:
+            has_more = False
+            break
+        cursor = (page[-1]['created_at'], page[-1]['id'])
+
+    if not posts:
+        st.caption('Nothing here yet.' if kind == 'timeline' else
+                   'Follow people from their goals to see them here.')
+    post_cards(posts, n_cols)
+    if has_more:
+        st.button('Load more', key='load_more', on_click=load_more_posts)
+
+
+def follow_button(author):
+    user_info = st.session_state['user_info']
+    if not user_info or not author or author == user_info['uid']:
+        return
+    if author in get_following(user_info['uid']):
+        st.button('Unfollow', key='unfollow', on_click=toggle_follow, args=(author, False))
+    else:
+        st.button('Follow', key='follow', on_click=toggle_follow, args=(author, True))
 
 
-def card_grid(n_cols, n_rows=10):
-    docs = stream_firebase("posts")
+def toggle_follow(author, follow):
+    uid = st.session_state['user_info']['uid']
+    if follow:
+        feeds.follow(db, uid, author)
+    else:
+        feeds.unfollow(db, uid, author)
+    get_following.clear()
+    fetch_feed_page.clear()
+
+
+def card_grid(n_cols, page_size=FEED_PAGE_SIZE):
+    posts = []
+    cursor = None
+    has_more = True
+    order = st.session_state['feed_order']
+    field = FEED_ORDERS[order]
+    for _ in range(st.session_state['feed_pages']):
+        page = fetch_posts_page(page_size, cursor, order)
+        posts.extend(page)
+        if len(page) < page_size:
+            has_more = False
+            break
+        cursor = (page[-1].get(field) if field else None, page[-1]['id'])
+
+    post_cards(posts, n_cols)
+    if has_more:
+        st.button('Load more', key='load_more', on_click=load_more_posts)
+
+
+def post_cards(posts, n_cols, key_prefix='view'):
+    # Only lay out as many rows as there are posts to show
+    names = author_names(posts)
+    for start in range(0, len(posts), n_cols):
+        cols = st.columns(n_cols)
+        for col, post, name in zip(cols, posts[start:start + n_cols],
+                                   names[start:start + n_cols]):
+            with col.container():
+                st.header(post["content"])
+                st.caption(name)
+                if 'message_count' in post:
+                    st.caption(f"{post.get('obstacle_count', 0)} obstacles · "
+                               f"{post['message_count']} messages")
+                clicked = st.button('View', key=f"{key_prefix}_{post['id']}")
+                if clicked:
+                    st.session_state['post'] = post
+                    st.session_state['toggle_post'] = True
+                    st.rerun()  # the thread view replaces the feed
+                st.divider()
+
+
+def as_posts(results):
+    posts = []
+    for r in results:
+        post = {'id': r['id'], 'content': r['content'],
+                'user_info': {'display_name': r['display_name']}}
+        if r.get('author'):
+            post['author'] = r['author']
+        posts.append(post)
+    return posts
+
+
+def search_results(n_cols):
+    query = st.session_state['search_input']
+    results = get_search_index().search(query, k=FEED_PAGE_SIZE)
+    st.subheader(f'Goals matching "{query}"')
+    if results:
+        post_cards(as_posts(results), n_cols, key_prefix='search')
+    else:
+        st.caption('No matching goals yet.')
 
-    rows = [st.container() for _ in range(n_rows)]
-    cols_per_row = [r.columns(n_cols) for r in rows]
-    cols = [column for row in cols_per_row for column in row]
 
-    for i, doc in enumerate(docs):
-        with cols[i].container():
-            post = doc.to_dict()
-            post['id'] = doc.id
-
-            st.header(post["content"])
-            if 'user_name' in post['user_info'].keys():  # todo: remove this
-                post['user_info']['display_name'] = post['user_info']['user_name']
-            st.caption(post['user_info']["display_name"])
-            clicked = st.button('View', key=i)
-            if clicked:
-                st.session_state['post'] = post
-                st.session_state['toggle_post'] = True
-            st.divider()
+def similar_goals(goal):
+    # Existing goals like this one, shown before asking GPT
+    results = get_search_index().similar(goal, k=3)
+    if results:
+        st.caption('Others are working on similar goals')
+        post_cards(as_posts(results), len(results), key_prefix='similar')
 
 
 def navbar():
     navbar = st.container()
     logo, left, center, right, button = navbar.columns([1, 1, 3, 1, 1])
-    logo.image("./public/logo.png", use_column_width=True)
-    left.empty()
+    logo.image(bootstrap.load_asset("./public/logo.png"), use_column_width=True)
+    left.text_input("Search", placeholder="Search goals", key="search_input",
+                    label_visibility="collapsed", on_change=request_app_rerun)
     right.empty()
 
     with button:
@@ -276,13 +645,16 @@ def navbar():
             clicked = login.button('Login')
             if clicked:
                 st.session_state['toggle_login'] = True
+                rerun_fragment()
             clicked = signup.button('Signup')
             if clicked:
                 st.session_state['toggle_signup'] = True
+                rerun_fragment()
         else:
             st.empty()
 
     with center.container():
+        show_notices()
         if st.session_state['toggle_login']:
             login_form()
         elif st.session_state['toggle_signup']:
@@ -290,7 +662,10 @@ def navbar():
         else:
             if st.session_state['toggle_dialog']:
                 if not st.session_state['toggle_gpt']:
+                    similar_goals(st.session_state['goal_input'])
                     initial_form()
+                elif st.session_state['gpt_pending']:
+                    stream_gpt_response()
                 elif st.session_state['gpt_response']:
                     st.write(st.session_state['gpt_response'])
                     st.text_input(
@@ -311,6 +686,7 @@ def post_expander():
         collection = f"posts/{post['id']}/obstacles"
         obstacles = stream_firebase(collection)
         st.header(post['content'])
+        follow_button(post.get('author'))
         for obstacle in obstacles:
             data = obstacle.to_dict()
             data['id'] = obstacle.id
@@ -324,15 +700,16 @@ def post_expander():
             st.subheader(obstacle['content'])
             st.divider()
             collection = f"posts/{post['id']}/obstacles/{obstacle['id']}/messages"
-            docs = stream_firebase(collection)
-            for doc in docs:
-                post = doc.to_dict()
-                name, content, space = st.columns([2, 5, 2])
-                if 'user_name' in post['user_info'].keys():  # todo: remove this
-                    post['user_info']['display_name'] = post['user_info']['user_name']
-                name.write(post['user_info']['display_name'])
-                content.write(post['content'])
-                space.empty()
+            # The newest window comes from the thread's shared listener,
+            # only older pages are read by this session
+            thread = get_thread(st.session_state['threads'], collection)
+            thread.refresh(get_live_cache())
+            if thread.has_older:
+                st.button("Load older", key="load_older",
+                          on_click=thread.load_older, args=(db, ))
+            messages = thread.visible()
+            for message, name in zip(messages, author_names(messages)):
+                st.markdown(f"**{name}** {message['content']}")
 
             st.text_input(
                 "message_input", key="message_input", label_visibility="collapsed")
@@ -346,6 +723,87 @@ def post_expander():
         st.session_state['toggle_post'] = False
         st.session_state['post'] = ''
         st.session_state['obstacle'] = ''
+        st.rerun()
+
+
+# Independently rerunnable units. A widget inside one only reruns that unit;
+# anything another unit depends on asks for a full rerun instead:
+#   navbar  -> main  search_input changes what the main area shows, and
+#                    signing in or out changes the feed tabs and buttons
+#   feed    -> app   View opens the thread view in place of the feed
+#   thread  -> app   Close returns to the feed, sending while signed out
+#                    opens the login form in the navbar
+
+
+def rerun_fragment():
+    # Fragment scope is only allowed while a fragment reruns on its own,
+    # during a full run fall back to rerunning everything
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def notify(level, text):
+    # Callbacks run before their fragment does, so anything they draw lands
+    # at the top of the app; they leave messages for the navbar instead
+    st.session_state['notices'].append((level, text))
+
+
+def show_notices():
+    # Kept for the full rerun when one has been asked for
+    if st.session_state['app_rerun']:
+        return
+    for level, text in st.session_state['notices']:
+        getattr(st, level)(text)
+    st.session_state['notices'] = []
+
+
+def request_app_rerun():
+    st.session_state['app_rerun'] = True
+
+
+def rerun_app_if_requested():
+    if st.session_state['app_rerun']:
+        st.session_state['app_rerun'] = False
+        st.rerun()
+
+
+@st.fragment
+def navbar_fragment():
+    with metrics.timed('fragment_seconds', fragment='navbar'):
+        navbar()
+    bootstrap.persist_session()
+    rerun_app_if_requested()
+
+
+@st.fragment
+def feed_fragment():
+    with metrics.timed('fragment_seconds', fragment='feed'):
+        if st.session_state['search_input']:
+            search_results(3)
+        else:
+            # A radio rather than st.tabs, which would read every tab's posts
+            # on every run
+            tab = st.radio("Feed", list(FEED_TABS), key='feed_tab', horizontal=True,
+                           label_visibility='collapsed', on_change=reset_feed_pages)
+            if FEED_TABS[tab] is None:
+                st.selectbox("Sort by", list(FEED_ORDERS), key='feed_order',
+                             on_change=reset_feed_pages)
+                card_grid(3)
+            else:
+                personal_feed(FEED_TABS[tab], 3)
+    bootstrap.persist_session()
+    rerun_app_if_requested()
+
+
+@st.fragment
+def thread_fragment():
+    with metrics.timed('fragment_seconds', fragment='thread'):
+        collect_write_acks()
+        post_expander()
+    bootstrap.persist_session()
+    rerun_app_if_requested()
 
 
 def login_form():
@@ -387,14 +845,34 @@ def initial_form():
             "Submit", on_click=initial_dialog, args=(goal, ))
 
 
-navbar()
+def dev_overlay():
+    # Open the app with ?debug=1 to see what this rerun and the process cost
+    rerun = st.session_state['perf']
+    with st.sidebar.expander('Performance', expanded=True):
+        st.caption('This rerun')
+        st.json(rerun)
+        st.caption('This process')
+        st.dataframe([
+            {'metric': h['name'], 'labels': str(h['labels']), 'count': h['count'],
+             'p50': h['p50'], 'p95': h['p95']}
+            for h in metrics.snapshot()['histograms']])
+
+
+get_search_index()
+resume_session()
+collect_write_acks()
+navbar_fragment()
 if st.session_state['toggle_post']:
-    post_expander()
+    thread_fragment()
 else:
-    card_grid(3)
+    feed_fragment()
+if st.session_state['auth_cookie'] is not None:
+    auth_session.write_cookie(st.session_state['auth_cookie'])
 
+metrics.end_run()
+rerun_seconds = time.perf_counter() - rerun_start
+metrics.observe('script_rerun_seconds', rerun_seconds)
+st.session_state['perf']['script_rerun_seconds'] = rerun_seconds
+if st.query_params.get('debug'):
+    dev_overlay()
 
-# # Tabs of Categories
-# categories = ["For You", "Following", "Your Posts"]
-# tab_list = st.tabs(categories)
-# for tab, category in zip(tab_list, categories):
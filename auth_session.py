@@ -0,0 +1,74 @@
+import secrets
+
+import streamlit as st
+from firebase_admin import auth
+from http_client import post_json, secure_token_url
+from session_store import get_store
+
+# {"idToken", "refreshToken", "localId"} for every signed-in browser, kept in
+# the session store under an auth sid so any worker can resume it. Only the
+# opaque sid travels, in a cookie rather than the URL, so sharing a link
+# never shares the account. The tokens stay on the server.
+AUTH_TTL = 30 * 24 * 3600  # seconds; Firebase refresh tokens don't expire sooner
+COOKIE_NAME = 'igniteme_auth'
+
+
+def save(login_res, sid=None):
+    sid = sid or secrets.token_urlsafe(24)
+    get_store().set(f"auth:{sid}", {"idToken": login_res["idToken"],
+                                    "refreshToken": login_res["refreshToken"],
+                                    "localId": login_res["localId"]}, AUTH_TTL)
+    return sid
+
+
+def forget(sid):
+    get_store().delete(f"auth:{sid}")
+
+
+def cookie_sid():
+    # The auth sid the browser sent when it connected, if it has one
+    return st.context.cookies.get(COOKIE_NAME)
+
+
+def write_cookie(sid):
+    # st.context only reads cookies, so the page sets its own; the next page
+    # load sends it. An empty sid deletes the cookie.
+    max_age = AUTH_TTL if sid else 0
+    st.iframe(
+        f"<script>parent.document.cookie = '{COOKIE_NAME}={sid}; Max-Age={max_age}; "
+        f"Path=/; SameSite=Strict; Secure';</script>", height=1)
+
+
+def refresh_id_token(refresh_token):
+    r = post_json(secure_token_url(),
+                  {"grant_type": "refresh_token", "refresh_token": refresh_token},
+                  params={"key": st.secrets["FIREBASE_WEB_API_KEY"]})
+    return r.json()
+
+
+def resume(sid):
+    # Returns the verified token claims for sid, or None if it must sign in.
+    # Verification is local against Google's cached public keys, the refresh
+    # endpoint is only called once the ID token has expired.
+    tokens = get_store().get(f"auth:{sid}")
+    if not tokens:
+        return None
+
+    try:
+        return auth.verify_id_token(tokens["idToken"])
+    except auth.ExpiredIdTokenError:
+        pass
+    except auth.CertificateFetchError:
+        return None
+    except (auth.InvalidIdTokenError, ValueError):
+        forget(sid)
+        return None
+
+    refreshed = refresh_id_token(tokens["refreshToken"])
+    if "id_token" not in refreshed:
+        forget(sid)
+        return None
+    save({"idToken": refreshed["id_token"],
+          "refreshToken": refreshed["refresh_token"],
+          "localId": refreshed["user_id"]}, sid)
+    return auth.verify_id_token(refreshed["id_token"])
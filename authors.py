@@ -0,0 +1,135 @@
+import argparse
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud.firestore_v1 import transforms
+
+import metrics
+
+# Posts and messages store their author's uid in `author`. Names are looked
+# up from the users collection when rendering, a whole screen's worth of
+# authors in one get_all, and kept for a while in a process-wide cache.
+# Documents written before this still embed a copy of user_info.
+
+PUBLIC_FIELDS = ("display_name", )
+
+
+class AuthorCache:
+    def __init__(self, db, ttl=600, max_size=10000):
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self._profiles = OrderedDict()  # uid -> (expires, public profile)
+        self._lock = threading.Lock()
+
+    def lookup(self, uids):
+        # {uid: public profile} for every uid, reading only the ones missing
+        # or expired, in a single batched get
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for uid in set(uids):
+                entry = self._profiles.get(uid)
+                if entry is not None and entry[0] > now:
+                    found[uid] = entry[1]
+                    self._profiles.move_to_end(uid)
+                else:
+                    missing.append(uid)
+        metrics.inc('author_cache_hits_total', len(found))
+        if not missing:
+            return found
+
+        metrics.inc('author_cache_misses_total', len(missing))
+        refs = [self.db.collection('users').document(uid) for uid in missing]
+        with metrics.timed('firestore_read_seconds', source='authors'):
+            snapshots = list(self.db.get_all(refs))
+        metrics.inc('firestore_documents_read_total', len(snapshots), source='authors')
+        for snapshot in snapshots:
+            self.put(snapshot.id, snapshot.to_dict() if snapshot.exists else {})
+            found[snapshot.id] = self._profiles[snapshot.id][1]
+        return found
+
+    def put(self, uid, profile):
+        public = {field: profile[field] for field in PUBLIC_FIELDS if field in profile}
+        if 'display_name' not in public and 'user_name' in profile:  # legacy users
+            public['display_name'] = profile['user_name']
+        with self._lock:
+            self._profiles[uid] = (time.monotonic() + self.ttl, public)
+            self._profiles.move_to_end(uid)
+            while len(self._profiles) > self.max_size:
+                self._profiles.popitem(last=False)
+
+
+def display_name(doc, profiles):
+    # The author's name from looked-up profiles, or the copy legacy
+    # documents embed
+    if doc.get('author') in profiles:
+        return profiles[doc['author']].get('display_name', '')
+    user_info = doc.get('user_info') or {}
+    return user_info.get('display_name') or user_info.get('user_name', '')
+
+
+def migrate(db, batch_size=400):
+    # Replaces the user_info copied into posts and messages with the author's
+    # uid, matched by email, and drops the passwords signup used to store in
+    # users. Streams the collections and commits a batch at a time.
+    uids, updated = {}, 0
+    batch, pending = db.batch(), 0
+
+    def update(doc_ref, data):
+        nonlocal batch, pending, updated
+        batch.update(doc_ref, data)
+        pending += 1
+        if pending == batch_size:
+            batch.commit()
+            updated += pending
+            batch, pending = db.batch(), 0
+
+    for user in db.collection('users').stream():
+        profile = user.to_dict()
+        if profile.get('email'):
+            uids[profile['email']] = user.id
+        changes = {}
+        if 'password' in profile:
+            changes['password'] = transforms.DELETE_FIELD
+        if 'user_name' in profile:
+            changes['user_name'] = transforms.DELETE_FIELD
+            changes.setdefault('display_name', profile.get('display_name') or profile['user_name'])
+        if changes:
+            update(user.reference, changes)
+
+    for docs in (db.collection('posts').stream(), db.collection_group('messages').stream()):
+        for doc in docs:
+            user_info = doc.to_dict().get('user_info')
+            if user_info is None:
+                continue
+            uid = uids.get(user_info.get('email'))
+            if uid is not None:
+                update(doc.reference, {'author': uid, 'user_info': transforms.DELETE_FIELD})
+            else:
+                # No account to point at: keep just the name
+                name = user_info.get('display_name') or user_info.get('user_name', '')
+                if user_info != {'display_name': name}:
+                    update(doc.reference, {'user_info': {'display_name': name}})
+    if pending:
+        batch.commit()
+        updated += pending
+    return updated
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Replace the user_info embedded in posts and messages with author uids")
+    parser.add_argument("--key-file", default="firestore-key.json",
+                        help="Service account key of the project to update.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    args = get_args()
+    firebase_admin.initialize_app(credentials.Certificate(args.key_file))
+    print(f"updated {migrate(firestore.client())} documents")
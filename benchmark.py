@@ -0,0 +1,243 @@
+import argparse
+import datetime
+import json
+import os
+import statistics
+import tempfile
+import time
+
+# Everything has to point at the stand-ins before app.py or openai is imported
+os.environ.setdefault("IGNITEME_FAKE_FIRESTORE", "1")
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("IGNITEME_INDEX_PATH", os.path.join(_tmp, "search_index"))
+os.environ.setdefault("IGNITEME_GPT_CACHE_PATH", os.path.join(_tmp, "gpt_responses.json"))
+
+import fake_firestore
+import firestore_dump
+import response_cache
+from fake_backends import FakeBackendServer
+from search_index import SearchIndex
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+SECRETS = {"OPENAI_API_KEY": "sk-fake", "FIREBASE_WEB_API_KEY": "fake-key",
+           "textkey": "{}"}
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "bench-password"
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark app.py components against in-memory Firestore and a fake OpenAI")
+    parser.add_argument("--posts", type=int, nargs="+", default=[10, 1000, 100000],
+                        help="Dataset sizes to run, in number of posts.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Measured runs per scenario.")
+    parser.add_argument("--gpt-latency", type=float, default=0.0,
+                        help="Seconds the fake OpenAI waits before answering.")
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="Seconds between streamed chunks.")
+    parser.add_argument("--model-latency", nargs="+", default=[], metavar="MODEL=SECONDS",
+                        help="Extra seconds the fake OpenAI waits for these models.")
+    parser.add_argument("--model-errors", nargs="+", default=[], metavar="MODEL=RATE",
+                        help="Share of requests for these models answered with a 503.")
+    parser.add_argument("--dump", default=None,
+                        help="Load this export (firestore_dump.py) instead of "
+                             "generating posts; --posts is then ignored.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON.")
+    return parser.parse_args()
+
+
+def per_model(values):
+    # ["gpt-4o=3"] -> {"gpt-4o": 3.0}
+    return {model: float(value) for model, value in (v.split("=") for v in values)}
+
+
+def start_backends(latency=0.0, token_latency=0.0, model_latency=None, model_errors=None):
+    server = FakeBackendServer(latency=latency, token_latency=token_latency,
+                               model_latency=model_latency,
+                               model_errors=model_errors).start()
+    server.add_user(BENCH_EMAIL, BENCH_PASSWORD, "bench-user")
+    os.environ["OPENAI_API_BASE"] = server.openai_api_base
+    os.environ["FIREBASE_AUTH_EMULATOR_HOST"] = server.host
+    return server
+
+
+def seed(db, n_posts, obstacles=3, messages=100, threads=10, dump=None):
+    # n_posts posts, the first `threads` of them with full message threads,
+    # or a snapshot of real data loaded from a dump
+    db.__init__()
+    db.collection("users").document("bench-user").set(
+        {"display_name": "Bench", "email": BENCH_EMAIL})
+    if dump is not None:
+        firestore_dump.load(db, dump)
+        n_posts = 0
+    for i in range(n_posts):
+        post_ref = db.collection("posts").document(f"post{i:07d}")
+        post_ref.set({"content": f"Goal number {i}", "author": "bench-user",
+                      "created_at": datetime.datetime(2023, 1, 1) + datetime.timedelta(seconds=i)})
+        if i >= threads:
+            continue
+        for j in range(obstacles):
+            obstacle_ref = post_ref.collection("obstacles").document(f"obs{j}")
+            obstacle_ref.set({"content": f"Obstacle {j} of goal {i}"})
+            for k in range(messages):
+                created_at = datetime.datetime(2023, 1, 1) + datetime.timedelta(minutes=k)
+                obstacle_ref.collection("messages").document().set(
+                    {"content": f"Reply {k}", "author": "bench-user",
+                     "created_at": created_at})
+    # Build the search index up front, as a warm process would have it on disk
+    SearchIndex().sync(db, os.environ["IGNITEME_INDEX_PATH"])
+    db.reset_counters()
+
+
+def new_app():
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_FILE, default_timeout=60)
+    for key, value in SECRETS.items():
+        at.secrets[key] = value
+    return at
+
+
+def find_button(at, label):
+    for button in at.button:
+        if button.label == label:
+            return button
+    raise LookupError(f"No button labelled {label!r}")
+
+
+# Each scenario prepares a session, then returns the interaction to measure
+
+def scenario_card_grid(at):
+    return lambda: at.run()
+
+
+def scenario_load_more(at):
+    at.run()
+    if not any(button.key == "load_more" for button in at.button):
+        return None  # everything fits on the first page
+    return lambda: at.button(key="load_more").click().run()
+
+
+def scenario_post_expander(at):
+    at.run()
+    # Buttons set state in the script body, so it shows on the following run
+    find_button(at, "View").click().run()
+    at.run()
+    # The first obstacle of the first post, whatever the dataset calls it
+    navigation = {"Login", "Signup", "Logout", "Close"}
+    obstacles = [b for b in at.button if b.key is None and b.label not in navigation]
+    if not obstacles:
+        return None
+    obstacles[0].click().run()
+    return lambda: at.run()
+
+
+def scenario_login(at):
+    at.run()
+    find_button(at, "Login").click().run()
+
+    def step():
+        at.text_input(key="email_input").input(BENCH_EMAIL)
+        at.text_input(key="password_input").input(BENCH_PASSWORD)
+        find_button(at, "Login").click().run()
+    return step
+
+
+def scenario_initial_dialog(at):
+    at.run()
+    at.text_input(key="goal_input").input("I want to exercise more").run()
+
+    def step():
+        at.text_input(key="obs_1").input("I am busy")
+        find_button(at, "Submit").click().run()
+    return step
+
+
+def scenario_initial_dialog_cached(at):
+    # Someone else already asked about the same goal and obstacles
+    scenario_initial_dialog(new_app())()
+    return scenario_initial_dialog(at)
+
+
+def scenario_follow_up_form(at):
+    scenario_initial_dialog(at)()
+
+    def step():
+        at.text_input(key="answer_input").input("Mornings, I confirm")
+        find_button(at, "Submit").click().run()
+    return step
+
+
+SCENARIOS = {
+    "card_grid": scenario_card_grid,
+    "card_grid_load_more": scenario_load_more,
+    "post_expander": scenario_post_expander,
+    "login": scenario_login,
+    "initial_dialog": scenario_initial_dialog,
+    "initial_dialog_cached": scenario_initial_dialog_cached,
+    "follow_up_form": scenario_follow_up_form,
+}
+
+
+def measure(name, setup, db, repeat):
+    import streamlit as st
+
+    seconds, reads = [], []
+    for _ in range(repeat):
+        # Fresh session and empty caches, so every run pays its own reads
+        st.cache_data.clear()
+        st.cache_resource.clear()
+        response_cache.get_cache().clear()
+        at = new_app()
+        step = setup(at)
+        if step is None:
+            return None
+        db.reset_counters()
+        start = time.perf_counter()
+        step()
+        seconds.append(time.perf_counter() - start)
+        reads.append(db.reads)
+        if at.exception:
+            raise RuntimeError(f"{name} raised: {at.exception[0].message}")
+    seconds.sort()
+    return {"median_ms": statistics.median(seconds) * 1000,
+            "max_ms": seconds[-1] * 1000,
+            "reads": statistics.median(reads)}
+
+
+def run(sizes, repeat, latency=0.0, token_latency=0.0, dump=None,
+        model_latency=None, model_errors=None):
+    start_backends(latency, token_latency, model_latency, model_errors)
+    db = fake_firestore.get_client()
+    report = {}
+    for n_posts in sizes:
+        seed(db, n_posts, dump=dump)
+        if dump is not None:
+            n_posts = len(db._collections.get("posts", {}))
+        report[n_posts] = {name: measure(name, setup, db, repeat)
+                           for name, setup in SCENARIOS.items()}
+    return report
+
+
+def print_report(report):
+    print(f"{'posts':>8}  {'scenario':<22}{'median ms':>11}{'max ms':>10}{'reads':>8}")
+    for n_posts, scenarios in report.items():
+        for name, result in scenarios.items():
+            if result is None:
+                print(f"{n_posts:>8}  {name:<22}{'n/a':>11}")
+                continue
+            print(f"{n_posts:>8}  {name:<22}{result['median_ms']:>11.1f}"
+                  f"{result['max_ms']:>10.1f}{result['reads']:>8.0f}")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    sizes = [None] if args.dump else args.posts
+    report = run(sizes, args.repeat, args.gpt_latency, args.token_latency, args.dump,
+                 per_model(args.model_latency), per_model(args.model_errors))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
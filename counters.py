@@ -0,0 +1,165 @@
+import argparse
+import random
+
+from google.cloud.firestore_v1 import transforms
+
+import metrics
+
+# Engagement counters kept on the post and obstacle documents, so feed cards
+# can show and sort by them without reading any subcollection. A document
+# with counter_shards set (a hot thread) has its increments spread over that
+# many shard documents instead, and rollup() adds them back in: its count is
+# the document's own plus whatever the shards hold.
+
+SHARDS_FIELD = 'counter_shards'
+SHARDS_COLLECTION = 'counter_shards'
+
+
+def shard_count(doc_ref):
+    # How many shards the document's counters are spread over, 0 for none
+    snapshot = doc_ref.get()
+    return (snapshot.to_dict() or {}).get(SHARDS_FIELD, 0) if snapshot.exists else 0
+
+
+def increment(doc_ref, shards=0, field='message_count', amount=1):
+    # The (reference, data, merge) write that adds amount to the document's
+    # counter, for committing in the same batch as whatever is being counted.
+    # shards is the document's own counter_shards, see shard_count.
+    data = {field: transforms.Increment(amount),
+            'last_activity_at': transforms.SERVER_TIMESTAMP}
+    if shards:
+        doc_ref = doc_ref.collection(SHARDS_COLLECTION).document(
+            str(random.randrange(shards)))
+    return doc_ref, data, True
+
+
+def enable_sharding(doc_ref, shards):
+    # The count so far stays on the document, new increments go to the shards
+    doc_ref.set({SHARDS_FIELD: shards}, merge=True)
+
+
+def shard_totals(doc_ref):
+    # Sum of the shards' counts, the latest activity among them, and each
+    # shard's count by reference
+    total, activity, counts = 0, None, {}
+    for shard in doc_ref.collection(SHARDS_COLLECTION).stream():
+        data = shard.to_dict()
+        counts[shard.reference] = data.get('message_count', 0)
+        total += counts[shard.reference]
+        last = data.get('last_activity_at')
+        if last and (activity is None or last > activity):
+            activity = last
+    return total, activity, counts
+
+
+def count(query):
+    # One aggregation query, billed per 1000 index entries rather than per doc
+    with metrics.timed('firestore_read_seconds', source='count'):
+        result = query.count().get()
+    return result[0][0].value
+
+
+def latest_message(messages_ref):
+    docs = messages_ref.order_by('created_at', direction='DESCENDING').limit(1).get()
+    return docs[0].to_dict()['created_at'] if docs else None
+
+
+def backfill_counts(db, batch_size=400):
+    # Recount every post and obstacle written before the counters existed,
+    # or whose counters have drifted. Only documents that change are written.
+    batch, pending, updated = db.batch(), 0, 0
+
+    def write(doc_ref, old, new):
+        nonlocal batch, pending, updated
+        counts = {}
+        if old.get(SHARDS_FIELD):
+            # A sharded count is the document's plus the shards': the recount
+            # goes on the document and the shards are emptied
+            in_shards, _, counts = shard_totals(doc_ref)
+            old = dict(old, message_count=old.get('message_count', 0) + in_shards)
+        changes = {k: v for k, v in new.items() if v is not None and old.get(k) != v}
+        if not changes:
+            return
+        if 'message_count' in changes:
+            for shard_ref, shard_count in counts.items():
+                if shard_count:
+                    batch.set(shard_ref, {'message_count': 0}, merge=True)
+                    pending += 1
+        batch.set(doc_ref, changes, merge=True)
+        pending += 1
+        if pending >= batch_size:
+            batch.commit()
+            updated += pending
+            batch, pending = db.batch(), 0
+
+    for post in db.collection('posts').stream():
+        post_data = post.to_dict()
+        obstacles = list(post.reference.collection('obstacles').stream())
+        post_total, post_activity = 0, post_data.get('created_at')
+        for obstacle in obstacles:
+            obstacle_data = obstacle.to_dict()
+            messages_ref = obstacle.reference.collection('messages')
+            total = count(messages_ref)
+            activity = latest_message(messages_ref) if total else None
+            write(obstacle.reference, obstacle_data,
+                  {'message_count': total, 'last_activity_at': activity})
+            post_total += total
+            if activity and (post_activity is None or activity > post_activity):
+                post_activity = activity
+        write(post.reference, post_data,
+              {'obstacle_count': len(obstacles), 'message_count': post_total,
+               'last_activity_at': post_activity})
+    if pending:
+        batch.commit()
+        updated += pending
+    return updated
+
+
+def rollup(db):
+    # Adds the shards of hot posts and obstacles into the counter the feed
+    # sorts on. Run it periodically while any thread is sharded. Each shard
+    # gives up exactly what was read from it, with Increment, in the same
+    # batch, so increments landing meanwhile stay in the shard for next time.
+    updated = 0
+    for collection in ('posts', 'obstacles'):
+        query = db.collection(collection) if collection == 'posts' \
+            else db.collection_group(collection)
+        for doc in query.where(SHARDS_FIELD, '>', 0).stream():
+            total, activity, counts = shard_totals(doc.reference)
+            if not total:
+                continue
+            batch = db.batch()
+            for shard_ref, shard_count in counts.items():
+                if shard_count:
+                    batch.set(shard_ref, {'message_count': transforms.Increment(-shard_count)},
+                              merge=True)
+            data = {'message_count': transforms.Increment(total)}
+            last = doc.to_dict().get('last_activity_at')
+            if activity and (last is None or activity > last):
+                data['last_activity_at'] = activity
+            batch.set(doc.reference, data, merge=True)
+            batch.commit()
+            updated += 1
+    return updated
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Recount obstacles and messages on posts, or roll up sharded counters")
+    parser.add_argument("command", choices=["backfill", "rollup"])
+    parser.add_argument("--key-file", default="firestore-key.json",
+                        help="Service account key of the project to update.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    args = get_args()
+    firebase_admin.initialize_app(credentials.Certificate(args.key_file))
+    db = firestore.client()
+    if args.command == "backfill":
+        print(f"updated {backfill_counts(db)} documents")
+    else:
+        print(f"rolled up {rollup(db)} documents")
@@ -0,0 +1,141 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local HTTP stand-ins for the OpenAI chat completions API and the Firebase
+# identity toolkit, with configurable latency. Point the app at them with
+# OPENAI_API_BASE and FIREBASE_AUTH_EMULATOR_HOST. Chat completions can be
+# slowed down or made to fail per model, to exercise the model router.
+
+CLARIFICATION = {"success": False,
+                 "response": "What usually gets in the way when you try to start?"}
+SUMMARY = {"success": True,
+           "response": "Here is the summary of your goal.",
+           "goal": {"content": "Exercise three times a week"},
+           "obstacles": [{"content": "No time after work"},
+                         {"content": "Gym is far away"}]}
+
+
+def coach_reply(messages):
+    # Confirming the summary finishes the dialog, anything else gets a question
+    last = messages[-1]["content"].lower() if messages else ""
+    return json.dumps(SUMMARY if "confirm" in last else CLARIFICATION)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        time.sleep(server.latency)
+        if self.path.split("?")[0].endswith("/chat/completions"):
+            self._chat(self._body())
+        elif "accounts:signInWithPassword" in self.path:
+            self._sign_in(self._body())
+        elif "securetoken.googleapis.com" in self.path:
+            self._send_json(400, {"error": {"message": "INVALID_REFRESH_TOKEN"}})
+        else:
+            self._send_json(404, {"error": {"message": "NOT_FOUND"}})
+
+    def _chat(self, request):
+        model = request.get("model", "gpt-3.5-turbo")
+        time.sleep(self.server.model_latency.get(model, 0))
+        if random.random() < self.server.model_errors.get(model, 0):
+            self._send_json(503, {"error": {"message": f"{model} is overloaded",
+                                            "type": "server_error"}})
+            return
+        content = self.server.responder(request.get("messages", []))
+        # With functions, the reply comes back as the forced call's arguments
+        function = (request.get("function_call") or {}).get("name")
+        if not request.get("stream"):
+            message = {"role": "assistant", "content": content}
+            if function:
+                message = {"role": "assistant", "content": None,
+                           "function_call": {"name": function, "arguments": content}}
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion",
+                "model": model, "created": int(time.time()),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        step = self.server.chunk_chars
+        for start in range(0, len(content), step):
+            delta = {"content": content[start:start + step]}
+            if function:
+                delta = {"function_call": {"arguments": content[start:start + step]}}
+            chunk = {"object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "finish_reason": None, "delta": delta}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.server.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def _sign_in(self, request):
+        user = self.server.users.get(request.get("email"))
+        if user is None:
+            self._send_json(400, {"error": {"message": "EMAIL_NOT_FOUND"}})
+        elif user["password"] != request.get("password"):
+            self._send_json(400, {"error": {"message": "INVALID_PASSWORD"}})
+        else:
+            self._send_json(200, {"localId": user["uid"], "email": request["email"],
+                                  "idToken": f"fake-id-{user['uid']}",
+                                  "refreshToken": f"fake-refresh-{user['uid']}",
+                                  "expiresIn": "3600", "registered": True})
+
+
+class FakeBackendServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, token_latency=0.0, chunk_chars=4,
+                 responder=coach_reply, model_latency=None, model_errors=None, port=0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.token_latency = token_latency
+        self.chunk_chars = chunk_chars
+        self.responder = responder
+        self.model_latency = model_latency or {}  # model -> extra seconds
+        self.model_errors = model_errors or {}  # model -> share of 503s
+        self.users = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def add_user(self, email, password, uid):
+        self.users[email] = {"password": password, "uid": uid}
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server_port}"
+
+    @property
+    def openai_api_base(self):
+        return f"http://{self.host}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
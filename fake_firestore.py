@@ -0,0 +1,436 @@
+import bisect
+import copy
+import datetime
+import random
+import string
+import threading
+
+try:
+    from google.cloud.firestore_v1 import transforms
+except ImportError:
+    transforms = None
+_DELETE_FIELD = getattr(transforms, "DELETE_FIELD", object())
+
+# In-memory stand-in for the subset of the Firestore client app.py uses.
+# Counts billed reads and writes so benchmarks can compare screens.
+
+_ID_CHARS = string.ascii_letters + string.digits
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _auto_id():
+    return "".join(random.choice(_ID_CHARS) for _ in range(20))
+
+
+def _get_field(data, field):
+    for part in field.split("."):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(field)
+        data = data[part]
+    return data
+
+
+def _apply_transforms(old, data):
+    # Resolve SERVER_TIMESTAMP / Increment sentinels against the old value
+    out = {}
+    for key, value in data.items():
+        previous = old.get(key) if isinstance(old, dict) else None
+        if isinstance(value, dict):
+            out[key] = _apply_transforms(previous or {}, value)
+        elif value is _DELETE_FIELD:
+            continue
+        elif transforms is not None and value is transforms.SERVER_TIMESTAMP:
+            out[key] = datetime.datetime.now(datetime.timezone.utc)
+        elif transforms is not None and isinstance(value, transforms.Increment):
+            out[key] = (previous or 0) + value.value
+        elif isinstance(value, datetime.datetime) and value.tzinfo is None:
+            # Firestore stores naive datetimes as UTC
+            out[key] = value.replace(tzinfo=datetime.timezone.utc)
+        else:
+            out[key] = copy.deepcopy(value)
+    return out
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return copy.deepcopy(_get_field(self._data, field))
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self):
+        return self._client._get(self)
+
+    def set(self, data, merge=False):
+        self._client._write([("set", self, data, merge)])
+
+    def update(self, data):
+        self._client._write([("update", self, data, True)])
+
+    def delete(self):
+        self._client._write([("delete", self, None, False)])
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class Query:
+    def __init__(self, client, path, filters=(), orders=(), limit=None,
+                 start_after=None, all_descendants=False, path_range=None):
+        self._client = client
+        self._path = path
+        self._all_descendants = all_descendants
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._path_range = path_range
+
+    def _copy(self, **changes):
+        params = {"filters": self._filters, "orders": self._orders,
+                  "limit": self._limit, "start_after": self._start_after,
+                  "all_descendants": self._all_descendants,
+                  "path_range": self._path_range}
+        params.update(changes)
+        return Query(self._client, self._path, **params)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, cursor):
+        if isinstance(cursor, DocumentSnapshot):
+            cursor = dict(cursor._data, __name__=cursor.reference.path)
+        return self._copy(start_after=cursor)
+
+    def stream(self):
+        return iter(self._client._run_query(self))
+
+    def get(self):
+        return list(self.stream())
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self, callback)
+
+    def count(self, alias=None):
+        return AggregationQuery(self, alias or "count")
+
+    def get_partitions(self, partition_count):
+        # Splits a collection group into ranges of document paths of about
+        # equal size, as the real client does for parallel reads
+        paths = sorted(path for path, _ in self._client._scan(self))
+        size = -(-len(paths) // max(partition_count, 1)) or 1
+        bounds = [None] + paths[size::size] + [None]
+        for start, end in zip(bounds, bounds[1:]):
+            yield QueryPartition(self, start, end)
+
+
+class QueryPartition:
+    def __init__(self, query, start_at, end_at):
+        self._query = query
+        self.start_at = start_at
+        self.end_at = end_at
+
+    def query(self):
+        return self._query._copy(path_range=(self.start_at, self.end_at))
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class AggregationQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias
+
+    def get(self):
+        return [[AggregationResult(self._alias, self._query._client._count(self._query))]]
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        if "/" not in self._path:
+            return None
+        return DocumentReference(self._client, self._path.rsplit("/", 1)[0])
+
+    def document(self, doc_id=None):
+        return DocumentReference(self._client, f"{self._path}/{doc_id or _auto_id()}")
+
+    def add(self, data):
+        doc_ref = self.document()
+        doc_ref.set(data)
+        return None, doc_ref
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self._writes.append(("set", doc_ref, data, merge))
+
+    def update(self, doc_ref, data):
+        self._writes.append(("update", doc_ref, data, True))
+
+    def delete(self, doc_ref):
+        self._writes.append(("delete", doc_ref, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._client._write(writes)
+
+
+class _Watch:
+    def __init__(self, client, query, callback):
+        self._client = client
+        self.query = query
+        self.callback = callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        self._client._unlisten(self)
+
+
+class FakeFirestore:
+    def __init__(self):
+        # collection path -> {doc id: data}, insertion ordered
+        self._collections = {}
+        self._sorted_ids = {}
+        self._watches = []
+        self._lock = threading.RLock()
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def collection_group(self, collection_id):
+        return Query(self, collection_id, all_descendants=True)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references):
+        # One round trip, billed a read per document as in Firestore
+        for doc_ref in references:
+            yield self._get(doc_ref)
+
+    def reset_counters(self):
+        self.reads = 0
+        self.writes = 0
+
+    def _get(self, doc_ref):
+        collection, doc_id = doc_ref.path.rsplit("/", 1)
+        with self._lock:
+            self.reads += 1
+            data = self._collections.get(collection, {}).get(doc_id)
+            return DocumentSnapshot(doc_ref, copy.deepcopy(data))
+
+    def _write(self, writes):
+        touched = {}
+        with self._lock:
+            for kind, doc_ref, data, merge in writes:
+                collection, doc_id = doc_ref.path.rsplit("/", 1)
+                docs = self._collections.setdefault(collection, {})
+                self._sorted_ids.pop(collection, None)
+                if kind == "delete":
+                    docs.pop(doc_id, None)
+                elif kind == "update" and doc_id not in docs:
+                    raise KeyError(f"No document to update: {doc_ref.path}")
+                else:
+                    old = docs.get(doc_id, {})
+                    new = _apply_transforms(old, data)
+                    if merge:
+                        new = {k: v for k, v in dict(old, **new).items()
+                               if data.get(k) is not _DELETE_FIELD}
+                    docs[doc_id] = new
+                self.writes += 1
+                touched.setdefault(collection, set()).add(doc_id)
+            watches = [w for w in self._watches if w.query._path in touched]
+        for watch in watches:
+            # A listener is billed one read per changed document
+            self._notify(watch, touched[watch.query._path])
+
+    def _run_query(self, query, count_reads=True):
+        if not query._filters and not query._all_descendants and \
+                query._orders == (("__name__", "ASCENDING"),):
+            matches = self._page_by_id(query)
+        else:
+            matches = self._scan(query)
+        if count_reads:
+            with self._lock:
+                self.reads += max(len(matches), 1)
+        return [DocumentSnapshot(DocumentReference(self, path), copy.deepcopy(data))
+                for path, data in matches]
+
+    def _count(self, query):
+        n = len(self._scan(query))
+        with self._lock:
+            # Aggregations are billed one read per 1000 index entries
+            self.reads += max((n + 999) // 1000, 1)
+        return n
+
+    def _page_by_id(self, query):
+        # Fast path for feed pages, so big datasets measure the app, not us
+        with self._lock:
+            docs = self._collections.get(query._path, {})
+            ids = self._sorted_ids.get(query._path)
+            if ids is None:
+                ids = self._sorted_ids[query._path] = sorted(docs)
+            start = 0
+            if query._start_after is not None:
+                start = bisect.bisect_right(ids, query._start_after["__name__"])
+            end = len(ids) if query._limit is None else start + query._limit
+            return [(f"{query._path}/{doc_id}", docs[doc_id]) for doc_id in ids[start:end]]
+
+    def _scan(self, query):
+        with self._lock:
+            if query._all_descendants:
+                # Collection group: every collection with this id, at any depth
+                docs = [(f"{path}/{doc_id}", data)
+                        for path, collection in self._collections.items()
+                        if path.rsplit("/", 1)[-1] == query._path
+                        for doc_id, data in collection.items()]
+            else:
+                docs = [(f"{query._path}/{doc_id}", data) for doc_id, data
+                        in self._collections.get(query._path, {}).items()]
+
+        if query._path_range is not None:
+            start, end = query._path_range
+            docs = [(path, data) for path, data in docs
+                    if (start is None or path >= start) and (end is None or path < end)]
+
+        matches = []
+        for path, data in docs:
+            try:
+                if all(_OPERATORS[op](_get_field(data, field), value)
+                       for field, op, value in query._filters):
+                    matches.append((path, data))
+            except KeyError:
+                continue
+
+        # Documents missing an order_by field are left out, as in Firestore
+        for field, direction in reversed(query._orders):
+            if field != "__name__":
+                matches = [(i, d) for i, d in matches if _has_field(d, field)]
+            matches.sort(key=lambda item: _sort_key(item, field),
+                         reverse=direction == "DESCENDING")
+
+        if query._start_after is not None and query._orders:
+            cursor = [query._start_after.get(field) for field, _ in query._orders]
+            cursor = [f"{query._path}/{value}"
+                      if field == "__name__" and "/" not in value else value
+                      for (field, _), value in zip(query._orders, cursor)]
+            matches = [item for item in matches
+                       if _after(item, query._orders, cursor)]
+        if query._limit is not None:
+            matches = matches[:query._limit]
+        return matches
+
+    def _listen(self, query, callback):
+        watch = _Watch(self, query, callback)
+        with self._lock:
+            self._watches.append(watch)
+        self._notify(watch)
+        return watch
+
+    def _unlisten(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, watch, changed_ids=None):
+        docs = self._run_query(watch.query, count_reads=False)
+        changes = docs if changed_ids is None else [
+            doc for doc in docs if doc.id in changed_ids]
+        with self._lock:
+            self.reads += max(len(docs), 1) if changed_ids is None else len(changed_ids)
+        watch.callback(docs, changes, datetime.datetime.now(datetime.timezone.utc))
+
+
+def _has_field(data, field):
+    try:
+        _get_field(data, field)
+    except KeyError:
+        return False
+    return True
+
+
+def _sort_key(item, field):
+    path, data = item
+    return path if field == "__name__" else _get_field(data, field)
+
+
+def _after(item, orders, cursor):
+    for (field, direction), value in zip(orders, cursor):
+        current = _sort_key(item, field)
+        if current == value:
+            continue
+        if direction == "DESCENDING":
+            return current < value
+        return current > value
+    return False
+
+
+_client = None
+
+
+def get_client():
+    # Shared instance, so a benchmark can seed the same data app.py reads
+    global _client
+    if _client is None:
+        _client = FakeFirestore()
+    return _client
@@ -0,0 +1,133 @@
+import argparse
+
+from google.cloud.firestore_v1 import transforms
+
+import metrics
+
+# Per-user lists kept up to date on write, so the Following and Your Posts
+# tabs are each one ordered query over a short subcollection:
+#   users/{uid}/following/{target}   who uid follows
+#   users/{uid}/followers/{follower} who follows uid
+#   users/{uid}/timeline/{post_id}   uid's own posts
+#   users/{uid}/feed/{post_id}       posts by uid and everyone uid follows
+# Entries carry just enough of the post to draw its card.
+
+FANOUT_BATCH = 400
+FOLLOW_BACKFILL = 20  # an author's latest posts copied into a new follower's feed
+
+
+def entry(post, created_at=transforms.SERVER_TIMESTAMP):
+    return {'content': post['content'], 'author': post['author'], 'created_at': created_at}
+
+
+def _user(db, uid):
+    return db.collection('users').document(uid)
+
+
+def followers(db, uid):
+    return [doc.id for doc in _user(db, uid).collection('followers').stream()]
+
+
+def following(db, uid):
+    return [doc.id for doc in _user(db, uid).collection('following').stream()]
+
+
+def own_writes(db, post_id, post_entry):
+    # The author's timeline and feed, committed with the post itself
+    user_ref = _user(db, post_entry['author'])
+    return [(user_ref.collection('timeline').document(post_id), post_entry),
+            (user_ref.collection('feed').document(post_id), post_entry)]
+
+
+def fan_out(db, post_id, post_entry):
+    # The post in every follower's feed, as lists of writes of at most
+    # FANOUT_BATCH each. Costs O(followers) on write, nothing extra on read.
+    writes = [(_user(db, follower).collection('feed').document(post_id), post_entry)
+              for follower in followers(db, post_entry['author'])]
+    metrics.inc('feed_fanout_writes_total', len(writes))
+    return [writes[i:i + FANOUT_BATCH] for i in range(0, len(writes), FANOUT_BATCH)]
+
+
+def follow(db, uid, target):
+    # Both edges in one batch, plus the target's latest posts in uid's feed
+    batch = db.batch()
+    batch.set(_user(db, uid).collection('following').document(target),
+              {'created_at': transforms.SERVER_TIMESTAMP})
+    batch.set(_user(db, target).collection('followers').document(uid),
+              {'created_at': transforms.SERVER_TIMESTAMP})
+    for doc in page(db, target, 'timeline', FOLLOW_BACKFILL):
+        batch.set(_user(db, uid).collection('feed').document(doc['id']),
+                  {k: v for k, v in doc.items() if k != 'id'})
+    batch.commit()
+
+
+def unfollow(db, uid, target):
+    # Posts already in uid's feed stay there
+    batch = db.batch()
+    batch.delete(_user(db, uid).collection('following').document(target))
+    batch.delete(_user(db, target).collection('followers').document(uid))
+    batch.commit()
+
+
+def page(db, uid, kind, page_size, start_after=None):
+    # Newest first; start_after is the (created_at, id) of the last entry
+    query = _user(db, uid).collection(kind).order_by(
+        'created_at', direction='DESCENDING').order_by(
+        '__name__', direction='DESCENDING').limit(page_size)
+    if start_after:
+        created_at, post_id = start_after
+        query = query.start_after({'created_at': created_at, '__name__': post_id})
+    entries = []
+    with metrics.timed('firestore_read_seconds', source=kind):
+        for doc in query.stream():
+            data = doc.to_dict()
+            data['id'] = doc.id
+            entries.append(data)
+    metrics.inc('firestore_documents_read_total', max(len(entries), 1), source=kind)
+    return entries
+
+
+def rebuild(db, batch_size=FANOUT_BATCH):
+    # Writes every post into its author's timeline and feed and its
+    # followers' feeds. Safe to rerun: entries are keyed by post id.
+    batch, pending, written = db.batch(), 0, 0
+    follower_lists = {}
+    for post in db.collection('posts').stream():
+        data = post.to_dict()
+        if not data.get('author') or 'created_at' not in data:
+            continue  # legacy post: run authors.py first
+        post_entry = entry(data, data['created_at'])
+        author = data['author']
+        if author not in follower_lists:
+            follower_lists[author] = followers(db, author)
+        writes = own_writes(db, post.id, post_entry) + [
+            (_user(db, follower).collection('feed').document(post.id), post_entry)
+            for follower in follower_lists[author]]
+        for doc_ref, value in writes:
+            batch.set(doc_ref, value)
+            pending += 1
+            if pending == batch_size:
+                batch.commit()
+                written += pending
+                batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+        written += pending
+    return written
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Rebuild every user's timeline and feed from posts")
+    parser.add_argument("--key-file", default="firestore-key.json",
+                        help="Service account key of the project to update.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    args = get_args()
+    firebase_admin.initialize_app(credentials.Certificate(args.key_file))
+    print(f"wrote {rebuild(firestore.client())} feed entries")
@@ -0,0 +1,244 @@
+import argparse
+import base64
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Streams the posts / obstacles / messages tree to one file per collection
+# group and loads such a dump back with batched writes. Each group is read
+# as a collection-group query split into partitions read in parallel, and
+# documents pass through a bounded queue, so memory stays flat however big
+# the dataset is.
+
+GROUPS = ("posts", "obstacles", "messages")
+QUEUE_SIZE = 10000  # documents in flight between readers and the writer
+ROW_GROUP = 5000  # parquet rows per row group
+BATCH_SIZE = 500  # Firestore's limit on writes per batch
+_DONE = object()
+
+
+def encode(value):
+    # Firestore values that JSON has no type for are tagged
+    if isinstance(value, datetime.datetime):
+        return {"__timestamp__": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    if isinstance(value, dict):
+        return {k: encode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if hasattr(value, "path") and hasattr(value, "id"):
+        return {"__reference__": value.path}
+    return value
+
+
+def decode(value, db=None):
+    if isinstance(value, dict):
+        if "__timestamp__" in value:
+            return datetime.datetime.fromisoformat(value["__timestamp__"])
+        if "__bytes__" in value:
+            return base64.b64decode(value["__bytes__"])
+        if "__reference__" in value:
+            return db.document(value["__reference__"]) if db else value["__reference__"]
+        return {k: decode(v, db) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decode(v, db) for v in value]
+    return value
+
+
+def _path(doc):
+    # Paths relative to the database root, whichever client produced them
+    path = doc.reference.path
+    return path.split("/documents/", 1)[-1]
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self._file = open(path, "w")
+
+    def write(self, path, data):
+        self._file.write(json.dumps({"path": path, "data": encode(data)}) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    # path and the document as a JSON string, flushed a row group at a time
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([("path", pa.string()), ("data", pa.string())])
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._rows = {"path": [], "data": []}
+
+    def write(self, path, data):
+        self._rows["path"].append(path)
+        self._rows["data"].append(json.dumps(encode(data)))
+        if len(self._rows["path"]) >= ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        if self._rows["path"]:
+            self._writer.write_table(
+                self._pa.Table.from_pydict(self._rows, schema=self._schema))
+            self._rows = {"path": [], "data": []}
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+WRITERS = {"jsonl": JsonlWriter, "parquet": ParquetWriter}
+
+
+def read_dump(path):
+    # Yields (document path, encoded data) from a .jsonl or .parquet file
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=ROW_GROUP):
+            for row in batch.to_pylist():
+                yield row["path"], json.loads(row["data"])
+    else:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                yield record["path"], record["data"]
+
+
+def export(db, out_dir, fmt="jsonl", partitions=8, groups=GROUPS):
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {}
+    for group in groups:
+        docs, failed = queue.Queue(QUEUE_SIZE), threading.Event()
+        parts = list(db.collection_group(group).get_partitions(partitions))
+
+        def read(partition):
+            try:
+                for doc in partition.query().stream():
+                    if failed.is_set():
+                        return
+                    docs.put((_path(doc), doc.to_dict()))
+            finally:
+                docs.put(_DONE)
+
+        writer = WRITERS[fmt](os.path.join(out_dir, f"{group}.{fmt}"))
+        counts[group] = 0
+        with ThreadPoolExecutor(partitions, thread_name_prefix="dump-read") as pool:
+            futures = [pool.submit(read, partition) for partition in parts]
+            running = len(parts)
+            try:
+                while running:
+                    item = docs.get()
+                    if item is _DONE:
+                        running -= 1
+                        continue
+                    writer.write(*item)
+                    counts[group] += 1
+            except BaseException:
+                failed.set()
+                while running:  # unblock readers waiting on a full queue
+                    running -= docs.get() is _DONE
+                raise
+            finally:
+                writer.close()
+            for future in futures:
+                future.result()  # surfaces a failed partition
+    return counts
+
+
+def load(db, dump_dir, batch_size=BATCH_SIZE, max_workers=4):
+    # Parents before children, so listeners and queries see a consistent tree
+    # as soon as each group is in. Commits run in parallel, at most
+    # 2 * max_workers batches held in memory at once.
+    counts = {}
+    in_flight = threading.Semaphore(2 * max_workers)
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="dump-write") as pool:
+        for group in GROUPS:
+            files = [os.path.join(dump_dir, f"{group}.{fmt}") for fmt in WRITERS]
+            files = [path for path in files if os.path.exists(path)]
+            if not files:
+                continue
+            futures, batch, pending = [], db.batch(), 0
+            counts[group] = 0
+
+            def commit(batch):
+                try:
+                    batch.commit()
+                finally:
+                    in_flight.release()
+
+            for path, data in read_dump(files[0]):
+                batch.set(db.document(path), decode(data, db))
+                pending += 1
+                if pending == batch_size:
+                    in_flight.acquire()
+                    futures.append(pool.submit(commit, batch))
+                    counts[group] += pending
+                    batch, pending = db.batch(), 0
+            if pending:
+                in_flight.acquire()
+                futures.append(pool.submit(commit, batch))
+                counts[group] += pending
+            for future in futures:
+                future.result()
+    return counts
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Export the posts/obstacles/messages tree, or load an export")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser(
+        "export", help="Stream every post, obstacle and message to files.")
+    export_parser.add_argument("out_dir", help="Directory to write one file per collection group to.")
+    export_parser.add_argument("--format", choices=list(WRITERS), default="jsonl",
+                               help="parquet needs pyarrow installed.")
+    export_parser.add_argument("--partitions", type=int, default=8,
+                               help="Parallel reads per collection group.")
+    export_parser.add_argument("--key-file", default="firestore-key.json",
+                               help="Service account key of the project to export. "
+                                    "Ignored when FIRESTORE_EMULATOR_HOST is set.")
+    import_parser = subparsers.add_parser(
+        "import", help="Load an export into the Firestore emulator.")
+    import_parser.add_argument("dump_dir", help="Directory written by export.")
+    import_parser.add_argument("--emulator", default=os.environ.get(
+        "FIRESTORE_EMULATOR_HOST", "localhost:8080"), help="Emulator host:port.")
+    import_parser.add_argument("--project", default="ignite-me-local",
+                               help="Project id to load into on the emulator.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    start = time.perf_counter()
+    if args.command == "export":
+        if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+            from google.cloud import firestore
+
+            db = firestore.Client(project=os.environ.get("GCLOUD_PROJECT", "ignite-me-local"))
+        else:
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+
+            firebase_admin.initialize_app(credentials.Certificate(args.key_file))
+            db = firestore.client()
+        counts = export(db, args.out_dir, args.format, args.partitions)
+    else:
+        # Only ever the emulator: a dump is never loaded into a live project
+        os.environ["FIRESTORE_EMULATOR_HOST"] = args.emulator
+        from google.cloud import firestore
+
+        counts = load(firestore.Client(project=args.project), args.dump_dir)
+    seconds = time.perf_counter() - start
+    total = sum(counts.values())
+    for group, n in counts.items():
+        print(f"{group:<10}{n:>10}")
+    print(f"{total} documents in {seconds:.1f}s ({total / max(seconds, 1e-9):.0f}/s)")
@@ -1,31 +1,375 @@
-import openai
+import functools
+import json
+import re
+import time
+
 import streamlit as st
 
+import metrics
+from gpt_scheduler import MAX_RETRIES, get_scheduler
+from model_router import get_router
+from response_cache import WAIT_TIMEOUT, cache_key, get_cache
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    # tiktoken is optional and only loaded on the first token count
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_openai():
+    # openai is slow to import, so wait until a coaching dialog needs it
+    import openai
+    openai.api_key = st.secrets["OPENAI_API_KEY"]
+    return openai
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Rough estimate when tiktoken isn't installed
+    return len(text) // 4 + 1
+
+
+def count_message_tokens(messages):
+    # Every message costs a few tokens of framing on top of its content
+    return sum(count_tokens(m["content"]) + 4 for m in messages) + 2
+
+
+_STRING = r'"(?:[^"\\]|\\.)*"'
+_COMMENT_OR_LITERAL = re.compile(_STRING + r'|#[^\n]*|//[^\n]*|\b(?:True|False|None)\b')
+_TRAILING_COMMA = re.compile(_STRING + r'|,(\s*[}\]])')
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _repair_json(text):
+    # Fixes what models commonly wrap around or leave in JSON: code fences and
+    # prose around the object, # and // comments, trailing commas and Python
+    # literals. Strings are matched first so their contents are left alone.
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return text
+    text = text[start:end + 1]
+
+    def comment_or_literal(match):
+        token = match.group()
+        if token.startswith('"'):
+            return token
+        return _LITERALS.get(token, "")
+
+    text = _COMMENT_OR_LITERAL.sub(comment_or_literal, text)
+    return _TRAILING_COMMA.sub(lambda m: m.group(1) or m.group(), text)
+
+
+def parse_json(text):
+    # json.loads, falling back to a local repair before anyone re-asks the
+    # model. Returns None if even the repaired text doesn't parse.
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        value = json.loads(_repair_json(text))
+    except ValueError:
+        metrics.inc("gpt_parse_failures_total")
+        return None
+    metrics.inc("gpt_parse_repairs_total")  # a round trip saved
+    return value
+
+
+# Output tokens reserved from the scheduler's budget until the real count is known
+RESPONSE_TOKENS = 500
+# Retries of a routed call while another model is left to fail over to
+FAILOVER_RETRIES = 1
+
 
 class GPT_API:
-    def __init__(self):
-        openai.api_key = st.secrets["OPENAI_API_KEY"]
+    def __init__(self, max_context_tokens=3000, recap_tokens=300, user=None):
+        # user is whoever the scheduler queues this conversation's calls under
+        self.user = user
         self.memory = True
+        self.use_cache = True
         self.messages = []
+        self.max_context_tokens = max_context_tokens
+        self.recap_tokens = recap_tokens
+        self.instructions_prompt = ""
+        self.schema = None
+        self.recap = []
+        self.last_tokens_sent = 0
+        self.total_tokens_sent = 0
+
+    # Plain-dict form, for the session store
+    def to_dict(self):
+        return {"messages": self.messages, "instructions_prompt": self.instructions_prompt,
+                "schema": self.schema,
+                "recap": self.recap, "max_context_tokens": self.max_context_tokens,
+                "recap_tokens": self.recap_tokens, "user": self.user,
+                "last_tokens_sent": self.last_tokens_sent,
+                "total_tokens_sent": self.total_tokens_sent}
+
+    @classmethod
+    def from_dict(cls, state):
+        gpt = cls(state["max_context_tokens"], state["recap_tokens"], state.get("user"))
+        gpt.schema = state.get("schema")
+        for key in ("messages", "instructions_prompt", "recap",
+                    "last_tokens_sent", "total_tokens_sent"):
+            setattr(gpt, key, state[key])
+        return gpt
 
     def system(self, prompt):
         self.messages.append({"role": "system", "content": prompt})
 
+    def instructions(self, prompt, schema=None):
+        # Sent once per request as the leading system message, replacing any
+        # previous instructions instead of repeating them in every user turn.
+        # With a schema (a function definition), replies are forced to be a
+        # call to it and the completion is that call's JSON arguments.
+        self.instructions_prompt = prompt
+        self.schema = schema
+
     def assistant(self, prompt):
         self.messages.append({"role": "assistant", "content": prompt})
 
-    def chat(self, prompt, temperature=1, model="gpt-3.5-turbo"):
+    @property
+    def route(self):
+        # Calls with a schema are routed by its name, e.g. "clarify"
+        return self.schema["name"] if self.schema else "default"
+
+    def chat(self, prompt, temperature=1, model=None, cache_if=None):
+        # cache_if(content) decides whether a fresh completion may be cached.
+        # Without a model, the router picks one for this call's route.
         self.messages.append({"role": "user", "content": prompt})
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=self.messages,
-            # temperature=temperature  # 0-2, degree of randomness
-            # docs: https://platform.openai.com/docs/api-reference/chat
-        )
+        payload = self._payload()
+        try:
+            content = "".join(self._complete(model, payload, False, cache_if))
+        except Exception:
+            self.messages.pop()  # so the prompt can be sent again
+            raise
+        self._remember(content)
+        return content
+
+    def chat_stream(self, prompt, temperature=1, model=None, cache_if=None):
+        # Same as chat, but yields the completion token by token
+        self.messages.append({"role": "user", "content": prompt})
+        payload = self._payload()
+        content = []
+        try:
+            for token in self._complete(model, payload, True, cache_if):
+                content.append(token)
+                yield token
+        except Exception:
+            self.messages.pop()  # so the prompt can be sent again
+            raise
+        self._remember("".join(content))
+
+    def _complete(self, model, payload, stream, cache_if):
+        # Yields the completion, from the response cache when the same request
+        # was answered before or is being answered for someone else right now
+        cache = get_cache() if self.use_cache else None
+        leader = False
+        if cache is not None:
+            # Routed calls share entries whichever model answered them
+            key = cache_key(model or f"route:{self.route}", payload, self.schema)
+            content = cache.get(key)
+            if content is None:
+                leader, future = cache.claim(key)
+                if not leader:
+                    try:
+                        content = future.result(WAIT_TIMEOUT)
+                    except Exception:
+                        content = None  # it failed, make our own request
+            if content is not None:
+                self.total_tokens_sent -= self.last_tokens_sent
+                self.last_tokens_sent = 0
+                yield content
+                return
 
+        chunks = []
+        try:
+            if model:
+                tokens = self._request(model, payload, stream)
+            else:
+                tokens = get_router().run(self.route, lambda routed, last: self._request(
+                    routed, payload, stream, MAX_RETRIES if last else FAILOVER_RETRIES))
+            for token in tokens:
+                chunks.append(token)
+                yield token
+        except BaseException as e:
+            if leader:
+                cache.fail(key, e if isinstance(e, Exception)
+                           else RuntimeError("request abandoned"))
+            raise
+        content = "".join(chunks)
+        if leader:
+            cache.put(key, content, store=cache_if is None or cache_if(content))
+
+    def _request(self, model, payload, stream, retries=MAX_RETRIES):
+        # Every call queues in the process-wide scheduler, and holds its slot
+        # until the last token has arrived
+        scheduler = get_scheduler()
+        kwargs = {}
+        if self.schema:
+            kwargs = {"functions": [self.schema],
+                      "function_call": {"name": self.schema["name"]}}
+        estimate = self.last_tokens_sent + RESPONSE_TOKENS
+        if self.schema:
+            estimate += count_tokens(json.dumps(self.schema))
+        with scheduler.slot(self.user, estimate) as ticket:
+            start = time.perf_counter()
+            response = scheduler.call(lambda: _get_openai().ChatCompletion.create(
+                model=model,
+                messages=payload,
+                stream=stream,
+                **kwargs,
+                # temperature=temperature  # 0-2, degree of randomness
+                # docs: https://platform.openai.com/docs/api-reference/chat
+            ), retries)
+            if not stream:
+                message = response.choices[0].message
+                content = message.get("content") or \
+                    message.get("function_call", {}).get("arguments", "")
+                ticket.used = self.last_tokens_sent + count_tokens(content)
+                self._record(model, "chat", time.perf_counter() - start, content)
+                yield content
+                return
+
+            content = []
+            for chunk in response:
+                delta = chunk["choices"][0]["delta"]
+                token = delta.get("content") or \
+                    delta.get("function_call", {}).get("arguments")
+                if token:
+                    if not content:
+                        metrics.observe("gpt_first_token_seconds",
+                                        time.perf_counter() - start, model=model)
+                    content.append(token)
+                    yield token
+            content = "".join(content)
+            ticket.used = self.last_tokens_sent + count_tokens(content)
+            self._record(model, "stream", time.perf_counter() - start, content)
+
+    def _record(self, model, mode, seconds, content):
+        metrics.observe("gpt_request_seconds", seconds, model=model, mode=mode)
+        metrics.inc("gpt_tokens_total", self.last_tokens_sent,
+                    model=model, direction="in")
+        metrics.inc("gpt_tokens_total", count_tokens(content),
+                    model=model, direction="out")
+
+    def _remember(self, content):
         if self.memory:
-            self.messages.append(
-                {"role": "assistant", "content": response["choices"][0]["message"].content})
+            self.messages.append({"role": "assistant", "content": content})
         else:
             self.messages = self.messages[:-1]
-        return response.choices[0].message.content
+
+    def _payload(self):
+        # Fold the oldest turns into a short recap until the request fits in
+        # max_context_tokens, always keeping the latest exchange verbatim
+        head = []
+        if self.instructions_prompt:
+            head.append({"role": "system", "content": self.instructions_prompt})
+        while True:
+            payload = head + self._recap_messages() + self.messages
+            tokens = count_message_tokens(payload)
+            if tokens <= self.max_context_tokens or len(self.messages) <= 2:
+                break
+            dropped = self.messages.pop(0)
+            self._add_to_recap(dropped)
+
+        self.last_tokens_sent = tokens
+        self.total_tokens_sent += tokens
+        return payload
+
+    def _recap_messages(self):
+        if not self.recap:
+            return []
+        recap = "Earlier in this conversation:\n" + "\n".join(self.recap)
+        return [{"role": "system", "content": recap}]
+
+    def _add_to_recap(self, message):
+        line = f"{message['role']}: {message['content'][:200]}"
+        self.recap.append(line)
+        # The first line is the original goal, drop the ones after it first
+        while len(self.recap) > 1 and \
+                count_tokens("\n".join(self.recap)) > self.recap_tokens:
+            del self.recap[1]
+
+
+_HEX4 = re.compile(r'[0-9a-fA-F]{4}')
+_LOW_SURROGATE = re.compile(r'\\u(d[c-f][0-9a-f]{2})', re.IGNORECASE)
+
+
+class JSONFieldExtractor:
+    # Pulls the value of one string field out of a JSON object while it is
+    # still being generated, so it can be shown before the object is complete
+    _escapes = {'"': '"', '\\': '\\', '/': '/', 'b': '\b',
+                'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, field):
+        self._start = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._buffer = ""
+        self._pos = None
+        self.done = False
+
+    def feed(self, text):
+        # Returns the newly decoded characters of the field value
+        self._buffer += text
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = self._start.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        out = []
+        buffer, pos = self._buffer, self._pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                self.done = True
+                pos += 1
+                break
+            if char != '\\':
+                out.append(char)
+                pos += 1
+                continue
+            # Wait for the rest of an escape sequence before decoding it
+            if pos + 1 >= len(buffer):
+                break
+            code = buffer[pos + 1]
+            if code == 'u':
+                if pos + 6 > len(buffer):
+                    break
+                if not _HEX4.fullmatch(buffer[pos + 2:pos + 6]):
+                    out.append(buffer[pos:pos + 2])  # not an escape after all
+                    pos += 2
+                    continue
+                char = int(buffer[pos + 2:pos + 6], 16)
+                if 0xD800 <= char < 0xDC00:
+                    # High surrogate: combine it with the low one after it
+                    following = buffer[pos + 6:pos + 12]
+                    if len(following) < 6 and "\\u".startswith(following[:2]):
+                        break
+                    low = _LOW_SURROGATE.fullmatch(following)
+                    if low:
+                        low = int(low.group(1), 16)
+                        out.append(chr(0x10000 + (char - 0xD800 << 10) + low - 0xDC00))
+                        pos += 12
+                        continue
+                    char = 0xFFFD
+                elif 0xDC00 <= char < 0xE000:
+                    char = 0xFFFD  # a low surrogate on its own
+                out.append(chr(char))
+                pos += 6
+            else:
+                out.append(self._escapes.get(code, code))
+                pos += 2
+        self._pos = pos
+        return "".join(out)
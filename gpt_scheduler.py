@@ -0,0 +1,163 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import metrics
+
+# Admission control for OpenAI calls, shared by every session in the process.
+# A call waits for one of MAX_CONCURRENCY slots and for its estimated tokens
+# in a tokens-per-minute bucket. Waiting calls are admitted round-robin by
+# user, so one busy session can't starve the rest. Rate limits and transient
+# errors are retried with jittered backoff, and a 429 empties the bucket so
+# every queued call slows down, not just the one that hit it.
+
+MAX_CONCURRENCY = int(os.environ.get("IGNITEME_GPT_MAX_CONCURRENCY", 8))
+TOKENS_PER_MINUTE = int(os.environ.get("IGNITEME_GPT_TPM", 90000))
+MAX_WAIT = 120  # seconds in the queue before giving up
+MAX_RETRIES = 4
+BACKOFF_BASE = 1  # seconds, doubled on every retry
+BACKOFF_MAX = 20
+RETRY_ERRORS = ("RateLimitError", "ServiceUnavailableError", "APIConnectionError",
+                "Timeout", "TryAgain", "APIError")
+
+
+class GPTUnavailable(Exception):
+    # Raised once a call has waited or retried as long as it may
+    pass
+
+
+class Ticket:
+    def __init__(self, user, tokens):
+        self.user = user
+        self.tokens = tokens
+        self.used = None  # tokens actually used, set by the caller if known
+        self.admitted = False
+
+
+class Scheduler:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY,
+                 tokens_per_minute=TOKENS_PER_MINUTE, max_wait=MAX_WAIT):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = max_wait
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # user -> deque of tickets, next user first
+        self._queued = 0
+        self._running = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+
+    @contextmanager
+    def slot(self, user, tokens):
+        # Holds a slot and the estimated tokens for the duration of the block;
+        # set ticket.used to give back what the call didn't need
+        ticket = Ticket(user, tokens)
+        start = time.perf_counter()
+        with self._cond:
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._queued += 1
+            self._wait(ticket, start)
+        metrics.observe("gpt_queue_wait_seconds", time.perf_counter() - start)
+        try:
+            yield ticket
+        finally:
+            with self._cond:
+                self._running -= 1
+                if ticket.used is not None:
+                    self._tokens += self._cost(ticket) - ticket.used
+                self._admit()
+
+    def call(self, fn, retries=MAX_RETRIES):
+        # fn() with retries on rate limits and transient errors
+        for attempt in range(retries + 1):
+            try:
+                return fn()
+            except Exception as e:
+                reason = type(e).__name__
+                if reason not in RETRY_ERRORS:
+                    raise
+                if attempt == retries:
+                    raise GPTUnavailable(str(e)) from e
+                metrics.inc("gpt_retries_total", reason=reason)
+                if reason == "RateLimitError":
+                    self.penalize()
+                time.sleep(_backoff(attempt, getattr(e, "headers", None)))
+
+    def penalize(self):
+        # Someone hit the rate limit: nobody else starts until the bucket refills
+        with self._cond:
+            self._tokens = min(self._tokens, 0)
+
+    def _cost(self, ticket):
+        # A call bigger than the whole budget still has to fit eventually
+        return min(ticket.tokens, self.tokens_per_minute)
+
+    def _wait(self, ticket, start):
+        # Called with the condition held
+        deadline = start + self.max_wait
+        while True:
+            self._admit()
+            if ticket.admitted:
+                return
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self._queues[ticket.user].remove(ticket)
+                if not self._queues[ticket.user]:
+                    del self._queues[ticket.user]
+                self._queued -= 1
+                self._update_gauges()
+                metrics.inc("gpt_queue_timeouts_total")
+                raise GPTUnavailable("Timed out waiting for an OpenAI slot")
+            # Wake up for a released slot, or when the bucket should have refilled
+            self._cond.wait(min(remaining, 1.0))
+
+    def _admit(self):
+        # Admits queued tickets round-robin by user while there is capacity
+        now = time.monotonic()
+        self._tokens = min(self.tokens_per_minute, self._tokens +
+                           (now - self._refilled) * self.tokens_per_minute / 60)
+        self._refilled = now
+        admitted = False
+        while self._queues and self._running < self.max_concurrency:
+            user, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            if self._tokens < self._cost(ticket):
+                break
+            queue.popleft()
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue  # to the back of the line
+            self._tokens -= self._cost(ticket)
+            self._running += 1
+            self._queued -= 1
+            ticket.admitted = admitted = True
+        if admitted:
+            self._cond.notify_all()
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.set_gauge("gpt_queue_depth", self._queued)
+        metrics.set_gauge("gpt_running", self._running)
+
+
+def _backoff(attempt, headers=None):
+    retry_after = (headers or {}).get("retry-after")
+    if retry_after and str(retry_after).isdigit():
+        return min(int(retry_after), BACKOFF_MAX)
+    delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
@@ -0,0 +1,86 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.25  # seconds, doubled on every retry
+BACKOFF_MAX = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_lock = threading.Lock()
+
+
+def identity_toolkit_url(method):
+    # Point FIREBASE_AUTH_EMULATOR_HOST at the Auth emulator or a local stub
+    emulator = os.environ.get("FIREBASE_AUTH_EMULATOR_HOST")
+    if emulator:
+        return f"http://{emulator}/identitytoolkit.googleapis.com/v1/{method}"
+    return f"https://identitytoolkit.googleapis.com/v1/{method}"
+
+
+def secure_token_url():
+    emulator = os.environ.get("FIREBASE_AUTH_EMULATOR_HOST")
+    if emulator:
+        return f"http://{emulator}/securetoken.googleapis.com/v1/token"
+    return "https://securetoken.googleapis.com/v1/token"
+
+
+def get_session():
+    # One keep-alive connection pool shared by every thread in the process
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def post_json(url, payload, params=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+              retries=MAX_RETRIES):
+    endpoint = urlsplit(url).path.rsplit("/", 1)[-1]
+    session = get_session()
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            r = session.post(url, params=params, json=payload, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            _record(endpoint, time.perf_counter() - start, error=True)
+            if attempt == retries:
+                raise
+            metrics.inc("http_retries_total", endpoint=endpoint)
+            time.sleep(_backoff(attempt))
+            continue
+
+        retry = r.status_code in RETRY_STATUSES and attempt < retries
+        _record(endpoint, time.perf_counter() - start,
+                error=r.status_code >= 500 or r.status_code == 429)
+        if not retry:
+            return r
+        metrics.inc("http_retries_total", endpoint=endpoint)
+        time.sleep(_backoff(attempt, r.headers.get("Retry-After")))
+
+
+def _backoff(attempt, retry_after=None):
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), BACKOFF_MAX)
+    delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+def _record(endpoint, seconds, error=False):
+    metrics.observe("http_request_seconds", seconds, endpoint=endpoint)
+    if error:
+        metrics.inc("http_request_errors_total", endpoint=endpoint)
@@ -0,0 +1,91 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+class CachedDocument:
+    # Minimal stand-in for a DocumentSnapshot: callers only use .id and .to_dict()
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class _Entry:
+    def __init__(self, query):
+        self.query = query
+        self.docs = OrderedDict()
+        self.ready = threading.Event()
+        self.watch = None
+
+
+class LiveCollectionCache:
+    # Process-wide cache of whole collections and of the tails of message
+    # threads, kept current by one snapshot listener each and evicted
+    # least-recently-used first
+    def __init__(self, db, max_collections=256, ready_timeout=5):
+        self.db = db
+        self.max_collections = max_collections
+        self.ready_timeout = ready_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def stream(self, collection):
+        return self.query(collection, lambda db: db.collection(collection))
+
+    def query(self, key, build):
+        # Results of the query build(db) returns, in query order, from one
+        # listener per key however many sessions read it
+        entry = self._get_or_subscribe(key, build)
+        if not entry.ready.wait(self.ready_timeout):
+            # The listener hasn't delivered yet, read directly this time
+            docs = list(entry.query.stream())
+            metrics.inc("firestore_documents_read_total", len(docs), source="query")
+            return docs
+        with self._lock:
+            return list(entry.docs.values())
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None and entry.watch is not None:
+            entry.watch.unsubscribe()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_or_subscribe(self, key, build):
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                watch = entry.watch
+                if watch is None or watch.is_active:
+                    self._entries.move_to_end(key)
+                    return entry
+                # The listener died, resubscribe below
+                del self._entries[key]
+            entry = _Entry(build(self.db))
+            self._entries[key] = entry
+            while len(self._entries) > self.max_collections:
+                evicted.append(self._entries.popitem(last=False)[1])
+
+        for cold in evicted:
+            if cold.watch is not None:
+                cold.watch.unsubscribe()
+
+        def on_snapshot(docs, changes, read_time):
+            # Listeners are billed per changed document, not per reader
+            metrics.inc("firestore_documents_read_total", len(changes), source="listener")
+            fresh = OrderedDict(
+                (doc.id, CachedDocument(doc.id, doc.to_dict())) for doc in docs)
+            with self._lock:
+                entry.docs = fresh
+            entry.ready.set()
+
+        entry.watch = entry.query.on_snapshot(on_snapshot)
+        return entry
@@ -0,0 +1,276 @@
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+# benchmark sets up the in-memory Firestore and other stand-ins on import
+import benchmark
+import fake_firestore
+
+# Ramps up concurrent scripted sessions in one process, the way one
+# Streamlit server runs them, and reports how rerun latency grows with them.
+# Every session repeats a visit: browse the feed, log in, open a post, reply
+# in a thread and start a coaching dialog, with think time between reruns.
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Find how many concurrent sessions one app.py process can serve")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32],
+                        help="Concurrent sessions at each step of the ramp.")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Seconds to run each step.")
+    parser.add_argument("--think", type=float, default=1.0,
+                        help="Mean seconds a user waits between reruns.")
+    parser.add_argument("--target-ms", type=float, default=2000,
+                        help="p95 rerun latency the process has to stay under, "
+                             "OpenAI round trips included.")
+    parser.add_argument("--posts", type=int, default=1000,
+                        help="Posts in the generated dataset.")
+    parser.add_argument("--gpt-latency", type=float, default=0.5,
+                        help="Seconds the fake OpenAI waits before answering.")
+    parser.add_argument("--token-latency", type=float, default=0.02,
+                        help="Seconds between streamed chunks.")
+    parser.add_argument("--require", type=int, default=None,
+                        help="Exit with status 1 unless the target holds, without "
+                             "errors, up to this many sessions, for release checks. "
+                             "Added to the ramp if it isn't a step already.")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the report as JSON.")
+    return parser.parse_args()
+
+
+def share_runtime():
+    # AppTest assumes one test runs at a time: every run installs a mock
+    # Runtime, secrets and config and takes them away again when it ends,
+    # under the feet of any other session mid-run. Install them once for the
+    # whole process instead, along with one script cache, so app.py is
+    # compiled once like on a server rather than on every rerun.
+    from unittest.mock import MagicMock
+
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+    from streamlit.runtime.caching.storage.dummy_cache_storage import \
+        MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.secrets import Secrets
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+    secrets = Secrets()
+    secrets._secrets = dict(benchmark.SECRETS)
+    st.secrets = secrets
+    config.set_option("global.appTest", True)
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+
+
+def new_app():
+    # benchmark.new_app, with the secrets already installed process-wide
+    at = benchmark.new_app()
+    at.secrets.clear()
+    return at
+
+
+def rss_mb():
+    # Current resident set size; peak size where /proc isn't available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+
+class Session:
+    # One simulated user with their own AppTest session
+    def __init__(self, number, deadline, think):
+        self.number = number
+        self.deadline = deadline
+        self.think = think
+        self.latencies = {}  # action -> seconds of each rerun
+        self.errors = []
+        self.at = None
+
+    def rerun(self, action, fn):
+        start = time.perf_counter()
+        fn()
+        self.latencies.setdefault(action, []).append(time.perf_counter() - start)
+        if self.at.exception:
+            raise RuntimeError(self.at.exception[0].message)
+        time.sleep(random.uniform(0, 2 * self.think))
+
+    def visit(self, n):
+        at = self.at = new_app()
+        self.rerun("feed", at.run)
+
+        benchmark.find_button(at, "Login").click()
+        self.rerun("login", at.run)
+        at.text_input(key="email_input").input(benchmark.BENCH_EMAIL)
+        at.text_input(key="password_input").input(benchmark.BENCH_PASSWORD)
+        benchmark.find_button(at, "Login").click()
+        self.rerun("login", at.run)
+
+        benchmark.find_button(at, "View").click()
+        self.rerun("open_post", at.run)
+        self.rerun("open_post", at.run)  # the click's state shows one run later
+        navigation = {"Login", "Signup", "Logout", "Close"}
+        obstacles = [b for b in at.button if b.key is None and b.label not in navigation]
+        if obstacles:
+            obstacles[0].click()
+            self.rerun("open_post", at.run)
+            at.text_input(key="message_input").input(f"Reply {self.number}.{n}")
+            at.button(key="message_button").click()
+            self.rerun("chat", at.run)
+        benchmark.find_button(at, "Close").click()
+        self.rerun("open_post", at.run)
+
+        at.text_input(key="goal_input").input(f"Exercise more, user {self.number}.{n}")
+        self.rerun("coaching", at.run)
+        at.text_input(key="obs_1").input("I am busy")
+        benchmark.find_button(at, "Submit").click()
+        self.rerun("coaching", at.run)
+
+    def run(self):
+        n = 0
+        while time.monotonic() < self.deadline:
+            try:
+                self.visit(n)
+            except Exception as e:
+                self.errors.append(f"{type(e).__name__}: {e}")
+            n += 1
+
+
+def run_step(n_sessions, duration, think):
+    deadline = time.monotonic() + duration
+    sessions = [Session(i, deadline, think) for i in range(n_sessions)]
+    threads = [threading.Thread(target=s.run, name=f"session-{s.number}") for s in sessions]
+    cpu, start = cpu_seconds(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    # Memory is read while every session is still open
+    time.sleep(duration / 2)
+    rss = rss_mb()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu
+
+    by_action = {}
+    for session in sessions:
+        for action, seconds in session.latencies.items():
+            by_action.setdefault(action, []).extend(seconds)
+    latencies = [s for seconds in by_action.values() for s in seconds]
+    return {
+        "sessions": n_sessions,
+        "reruns_per_second": len(latencies) / elapsed,
+        "p50_ms": _ms(percentile(latencies, 0.5)),
+        "p95_ms": _ms(percentile(latencies, 0.95)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "errors": sum(len(s.errors) for s in sessions),
+        "first_error": next((s.errors[0] for s in sessions if s.errors), None),
+        "cpu_percent": cpu / elapsed * 100,
+        "rss_mb": rss,
+        "actions_p95_ms": {action: _ms(percentile(seconds, 0.95))
+                           for action, seconds in by_action.items()},
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def run(levels, duration, think, target_ms, posts=1000, latency=0.5, token_latency=0.02):
+    benchmark.start_backends(latency, token_latency)
+    benchmark.seed(fake_firestore.get_client(), posts)
+    share_runtime()
+    # One warm-up visit, so imports and caches aren't billed to the first step
+    Session(-1, 0, 0).visit(0)
+    gc.collect()
+    baseline = rss_mb()
+
+    steps, knee = [], None
+    for n_sessions in sorted(levels):
+        step = run_step(n_sessions, duration, think)
+        step["cpu_percent_per_session"] = step["cpu_percent"] / n_sessions
+        step["mb_per_session"] = (step["rss_mb"] - baseline) / n_sessions
+        steps.append(step)
+        if step["p95_ms"] is None or step["p95_ms"] > target_ms:
+            knee = n_sessions
+            break  # past the knee, more sessions only take longer
+        gc.collect()
+    return {"target_ms": target_ms, "baseline_rss_mb": baseline,
+            "knee": knee, "steps": steps}
+
+
+def check_required(report, n_sessions):
+    # Why the run doesn't show the process serving n_sessions, if it doesn't
+    for step in report["steps"]:
+        if step["sessions"] > n_sessions:
+            break
+        if step["errors"]:
+            return f"{step['errors']} errors at {step['sessions']} sessions"
+        if step["sessions"] == report["knee"]:
+            return f"p95 went over the target at {step['sessions']} sessions"
+    if not any(step["sessions"] >= n_sessions for step in report["steps"]):
+        return f"no step ran {n_sessions} sessions"
+    return None
+
+
+def print_report(report):
+    print(f"{'sessions':>8}{'reruns/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'errors':>8}{'cpu %/sess':>12}{'MB/sess':>9}")
+    for step in report["steps"]:
+        print(f"{step['sessions']:>8}{step['reruns_per_second']:>10.1f}"
+              f"{step['p50_ms'] or 0:>9.0f}{step['p95_ms'] or 0:>9.0f}"
+              f"{step['p99_ms'] or 0:>9.0f}{step['errors']:>8}"
+              f"{step['cpu_percent_per_session']:>12.1f}{step['mb_per_session']:>9.1f}")
+    for step in report["steps"]:
+        if step["first_error"]:
+            print(f"first error at {step['sessions']} sessions: {step['first_error']}")
+    slowest = report["steps"][-1]["actions_p95_ms"]
+    print("p95 by action at the last step: " +
+          ", ".join(f"{action} {ms:.0f} ms" for action, ms in slowest.items()))
+    if report["knee"] is None:
+        print(f"p95 stayed under {report['target_ms']:.0f} ms at every step")
+    else:
+        print(f"p95 went over {report['target_ms']:.0f} ms at {report['knee']} sessions")
+
+
+if __name__ == "__main__":
+    args = get_args()
+    levels = set(args.sessions)
+    if args.require is not None:
+        levels.add(args.require)
+    report = run(levels, args.duration, args.think, args.target_ms,
+                 args.posts, args.gpt_latency, args.token_latency)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if args.require is not None:
+        failure = check_required(report, args.require)
+        if failure:
+            sys.exit(f"--require {args.require} failed: {failure}")
@@ -0,0 +1,122 @@
+import argparse
+
+from google.cloud.firestore_v1 import transforms
+
+import metrics
+
+THREAD_WINDOW = 30
+DESCENDING = "DESCENDING"
+
+
+class ThreadWindow:
+    # The messages of one thread this session has seen, oldest first. The
+    # newest window, and anything posted after it, comes from one listener
+    # per thread shared by every session; only load_older queries Firestore,
+    # paging backwards a window at a time.
+    def __init__(self, collection, window=THREAD_WINDOW):
+        self.collection = collection
+        self.window = window
+        self.messages = []
+        self.pending = {}
+        self.has_older = False
+
+    def refresh(self, live_cache):
+        docs = live_cache.query(
+            ('tail', self.collection, self.window),
+            lambda db: self._query(db, DESCENDING).limit(self.window))
+        metrics.inc('firestore_documents_served_total', len(docs), source='thread')
+        tail = [self._message(doc) for doc in reversed(docs)]
+        if not self.messages:
+            self.has_older = len(tail) == self.window
+        # Messages that scroll out of the shared tail stay on this session's
+        # screen, new ones are merged in by created_at
+        seen = {message['id'] for message in self.messages}
+        fresh = [message for message in tail if message['id'] not in seen]
+        if fresh:
+            self.messages.extend(fresh)
+            self.messages.sort(key=lambda m: (m['created_at'], m['id']))
+        for message in tail:
+            self.pending.pop(message['id'], None)
+
+    def load_older(self, db):
+        if not self.messages:
+            return
+        query = self._query(db, DESCENDING).start_after(
+            self._cursor(self.messages[0])).limit(self.window)
+        older = list(reversed(self._fetch(query)))
+        self.has_older = len(older) == self.window
+        self.messages[:0] = older
+
+    def add_pending(self, doc_id, data):
+        # Shown at the bottom until the listener delivers the committed message
+        self.pending[doc_id] = dict(data, id=doc_id)
+
+    def drop_pending(self, doc_id):
+        # Its write failed, so the listener will never deliver it
+        self.pending.pop(doc_id, None)
+
+    def visible(self):
+        return self.messages + list(self.pending.values())
+
+    def _query(self, db, direction="ASCENDING"):
+        # created_at ties are broken by document id, so cursors are exact
+        return db.collection(self.collection).order_by(
+            'created_at', direction=direction).order_by('__name__', direction=direction)
+
+    def _cursor(self, message):
+        return {'created_at': message['created_at'], '__name__': message['id']}
+
+    def _message(self, doc):
+        message = doc.to_dict()
+        message['id'] = doc.id
+        return message
+
+    def _fetch(self, query):
+        with metrics.timed('firestore_read_seconds', source='thread'):
+            messages = [self._message(doc) for doc in query.stream()]
+        metrics.inc('firestore_documents_read_total', max(len(messages), 1),
+                    source='thread')
+        return messages
+
+
+def get_thread(threads, collection):
+    if collection not in threads:
+        threads[collection] = ThreadWindow(collection)
+    return threads[collection]
+
+
+def backfill_timestamps(db, batch_size=400):
+    # Messages written before created_at existed are invisible to the ordered
+    # thread queries. Stamp them with their creation time.
+    batch, pending, updated = db.batch(), 0, 0
+    for doc in db.collection_group('messages').stream():
+        if 'created_at' in doc.to_dict():
+            continue
+        created = getattr(doc, 'create_time', None) or transforms.SERVER_TIMESTAMP
+        batch.update(doc.reference, {'created_at': created})
+        pending += 1
+        if pending == batch_size:
+            batch.commit()
+            updated += pending
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+        updated += pending
+    return updated
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Add created_at to messages written before it existed")
+    parser.add_argument("--key-file", default="firestore-key.json",
+                        help="Service account key of the project to update.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    args = get_args()
+    firebase_admin.initialize_app(credentials.Certificate(args.key_file))
+    print(f"updated {backfill_timestamps(firestore.client())} messages")
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Process-wide counters and latency histograms for the hot paths, exported as
+# Prometheus text or JSON. Values are also added to the current session's
+# counters while a script run has called begin_run.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_local = threading.local()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+    session = getattr(_local, "session", None)
+    if session is not None:
+        session[name] = session.get(name, 0) + value
+
+
+def observe(name, seconds, **labels):
+    with _lock:
+        key = _key(name, labels)
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(seconds)
+    session = getattr(_local, "session", None)
+    if session is not None:
+        session[name] = session.get(name, 0) + seconds
+
+
+def set_gauge(name, value, **labels):
+    # Current value of something, like a queue depth; not summed per session
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def begin_run(session_counters):
+    # Attribute everything recorded on this thread to one session's dict
+    session_counters.clear()
+    _local.session = session_counters
+
+
+def end_run():
+    _local.session = None
+
+
+def snapshot():
+    with _lock:
+        counters = [{"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(_counters.items())]
+        histograms = [{"name": name, "labels": dict(labels), "count": h.count,
+                       "sum": h.sum, "p50": h.quantile(0.5), "p95": h.quantile(0.95),
+                       "buckets": dict(zip(map(str, h.buckets), h.counts))}
+                      for (name, labels), h in sorted(_histograms.items())]
+        gauges = [{"name": name, "labels": dict(labels), "value": value}
+                  for (name, labels), value in sorted(_gauges.items())]
+    return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+def to_prometheus():
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), h in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                le = labels + (("le", str(bound)),)
+                lines.append(f"{name}_bucket{_format_labels(le)} {cumulative}")
+            le = labels + (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{_format_labels(le)} {h.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {h.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {h.count}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _gauges.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host="127.0.0.1"):
+    # /metrics in Prometheus text format and /metrics.json, on a side port
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
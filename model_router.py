@@ -0,0 +1,229 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import metrics
+from gpt_scheduler import GPTUnavailable
+
+# Picks the model for each GPT call from a route: an ordered list of models
+# for one kind of call, with a latency budget. Tracks rolling latency and
+# errors per model. A model whose p95 is over the route's budget, or whose
+# error rate is too high, drops to the back of the list. Calls that fail
+# before their first token fail over to the next model, and a call still
+# waiting for its first token after the primary's p95 time to first token is
+# hedged: the next model is asked too and whichever starts answering first wins.
+
+ROUTES = {
+    # Short clarification questions: fast first
+    "clarify": {"models": ["gpt-3.5-turbo", "gpt-4o-mini"], "budget": 4},
+    # The structured summary the post is built from: quality first
+    "summarize": {"models": ["gpt-4o", "gpt-3.5-turbo"], "budget": 10},
+    "default": {"models": ["gpt-3.5-turbo"], "budget": 10},
+}
+if os.environ.get("IGNITEME_GPT_ROUTES"):
+    ROUTES = dict(ROUTES, **json.loads(os.environ["IGNITEME_GPT_ROUTES"]))
+
+WINDOW = 100  # latest calls per model
+WINDOW_SECONDS = 600
+MIN_SAMPLES = 5  # before a model can be judged
+MAX_ERROR_RATE = 0.25
+HEDGE = True
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = deque(maxlen=WINDOW)  # (time, seconds, ok, first token seconds)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok, first_token=None):
+        with self._lock:
+            self.calls.append((time.monotonic(), seconds, ok, first_token))
+
+    def _recent(self):
+        cutoff = time.monotonic() - WINDOW_SECONDS
+        with self._lock:
+            while self.calls and self.calls[0][0] < cutoff:
+                self.calls.popleft()
+            return list(self.calls)
+
+    def summary(self):
+        calls = self._recent()
+        latencies = sorted(seconds for _, seconds, ok, _ in calls if ok)
+        first_tokens = sorted(first for _, _, _, first in calls if first is not None)
+        errors = sum(1 for _, _, ok, _ in calls if not ok)
+
+        def quantile(values, q):
+            if not values:
+                return None
+            return values[min(int(q * len(values)), len(values) - 1)]
+        return {"samples": len(calls), "p50": quantile(latencies, 0.5),
+                "p95": quantile(latencies, 0.95),
+                "first_token_p95": quantile(first_tokens, 0.95),
+                "error_rate": errors / len(calls) if calls else 0.0}
+
+
+class Router:
+    def __init__(self, routes=ROUTES, hedge=HEDGE):
+        self.routes = routes
+        self.hedge = hedge
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, model):
+        with self._lock:
+            if model not in self.stats:
+                self.stats[model] = ModelStats()
+            return self.stats[model]
+
+    def degraded(self, model, budget):
+        summary = self._stats(model).summary()
+        if summary["samples"] < MIN_SAMPLES:
+            return False
+        return summary["error_rate"] > MAX_ERROR_RATE or \
+            (summary["p95"] is not None and summary["p95"] > budget)
+
+    def candidates(self, route):
+        # Healthy models in the configured order, then the degraded ones
+        config = self.routes.get(route, self.routes["default"])
+        healthy = [m for m in config["models"] if not self.degraded(m, config["budget"])]
+        return healthy + [m for m in config["models"] if m not in healthy]
+
+    def hedge_after(self, route, model):
+        # Seconds to wait for a first token before asking the next model too
+        budget = self.routes.get(route, self.routes["default"])["budget"]
+        p95 = self._stats(model).summary()["first_token_p95"]
+        return budget if p95 is None else min(p95, budget)
+
+    def record(self, model, seconds, ok, first_token=None):
+        stats = self._stats(model)
+        stats.record(seconds, ok, first_token)
+        summary = stats.summary()
+        metrics.set_gauge("gpt_model_error_rate", summary["error_rate"], model=model)
+        if summary["p95"] is not None:
+            metrics.set_gauge("gpt_model_p95_seconds", summary["p95"], model=model)
+
+    def run(self, route, attempt):
+        # Yields the completion of attempt(model, last) from the first model
+        # that starts answering. attempt returns a token generator; last is
+        # True for the final candidate, which may retry as long as it likes.
+        models = self.candidates(route)
+        tried, error = set(), None
+        for i, model in enumerate(models):
+            if model in tried:
+                continue  # already failed as the backup of a hedged race
+            rest = [m for m in models[i + 1:] if m not in tried]
+            backup = rest[0] if self.hedge and rest else None
+            if tried:
+                metrics.inc("gpt_failovers_total", route=route, model=model)
+            metrics.inc("gpt_route_total", route=route, model=model)
+            started = False
+            try:
+                for token in self._race(route, model, backup, attempt, models[-1], tried):
+                    started = True
+                    yield token
+                return
+            except Exception as e:
+                if started:
+                    raise  # too late to switch, the user has seen part of it
+                error = e
+        if isinstance(error, GPTUnavailable):
+            raise error
+        raise GPTUnavailable(str(error)) from error
+
+    def _timed(self, model, tokens, cancelled=None):
+        # Records how long the model took to its first token and to finish,
+        # or to fail
+        start = time.perf_counter()
+        first_token = None
+        try:
+            for token in tokens:
+                if cancelled is not None and cancelled.is_set():
+                    return
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                yield token
+        except Exception:
+            self.record(model, time.perf_counter() - start, False, first_token)
+            raise
+        if cancelled is None or not cancelled.is_set():
+            seconds = time.perf_counter() - start
+            self.record(model, seconds, True, seconds if first_token is None else first_token)
+
+    def _race(self, route, primary, backup, attempt, last, tried):
+        # Adds every model it started to tried
+        tried.add(primary)
+        if backup is None:
+            yield from self._timed(primary, attempt(primary, primary == last))
+            return
+
+        # Both attempts run in threads and report to one queue; the first to
+        # produce a token (or finish) wins and the other one is abandoned
+        events = queue.Queue()
+        cancelled, started = {}, {}
+
+        def start(model):
+            cancelled[model] = threading.Event()
+            started[model] = time.perf_counter()
+
+            def target():
+                try:
+                    for token in self._timed(model, attempt(model, model == last),
+                                             cancelled[model]):
+                        events.put(("token", model, token))
+                except Exception as e:
+                    events.put(("error", model, e))
+                else:
+                    events.put(("done", model, None))
+            threading.Thread(target=target, daemon=True, name=f"gpt-{model}").start()
+
+        start(primary)
+        running = {primary}
+        deadline = time.monotonic() + self.hedge_after(route, primary)
+        while True:
+            timeout = None
+            if backup not in cancelled:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                kind, model, value = events.get(timeout=timeout)
+            except queue.Empty:
+                metrics.inc("gpt_hedges_total", route=route, model=backup)
+                tried.add(backup)
+                start(backup)
+                running.add(backup)
+                continue
+            if kind != "error":
+                break
+            running.discard(model)
+            if not running:
+                raise value
+
+        winner = model
+        for other in running - {winner}:
+            # Count the abandoned call as at least this slow, or a model that
+            # is always hedged would never look slow
+            cancelled[other].set()
+            seconds = time.perf_counter() - started[other]
+            self.record(other, seconds, True, seconds)
+        while True:
+            if model == winner:
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise value
+                yield value
+            kind, model, value = events.get()
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router()
+        return _router
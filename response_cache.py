@@ -0,0 +1,140 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Completions keyed on the model and the normalized request, so the same goal
+# and obstacles typed again (by anyone) don't pay for another round trip.
+# LRU with a TTL, saved to disk every SAVE_EVERY new entries and at exit.
+# Identical requests arriving while one is in flight wait for its result.
+
+CACHE_PATH = os.environ.get("IGNITEME_GPT_CACHE_PATH", ".cache/gpt_responses.json")
+MAX_ENTRIES = 5000
+TTL = 7 * 24 * 3600  # seconds
+SAVE_EVERY = 20
+WAIT_TIMEOUT = 120  # seconds a duplicate request waits for the first one
+
+
+def _normalize(text):
+    return " ".join(text.lower().split())
+
+
+def cache_key(model, messages, schema=None):
+    normalized = [[m["role"], _normalize(m["content"])] for m in messages]
+    blob = json.dumps([model, normalized, schema], separators=(",", ":"), sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES, ttl=TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires, content), wall clock
+        self._inflight = {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.inc("gpt_cache_requests_total", result="hit" if entry else "miss")
+        return entry[1] if entry else None
+
+    def claim(self, key):
+        # (True, future) if the caller should make the request and then call
+        # put or fail, (False, future) to wait on someone else's
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                metrics.inc("gpt_cache_requests_total", result="shared")
+                return False, future
+            future = self._inflight[key] = Future()
+            return True, future
+
+    def put(self, key, content, store=True):
+        with self._lock:
+            if store:
+                self._entries[key] = (time.time() + self.ttl, content)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                self._unsaved += 1
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_result(content)
+        if self._unsaved >= SAVE_EVERY:
+            self.save()
+
+    def fail(self, key, error):
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def save(self):
+        # Best effort: a failed save is logged, never raised into a chat
+        with self._lock:
+            now = time.time()
+            entries = [[key, expires, content]
+                       for key, (expires, content) in self._entries.items() if expires > now]
+            self._unsaved = 0
+        tmp = None
+        try:
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            # A temp file of our own, other threads and workers save too
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            log.exception("Saving the GPT response cache to %s failed", self.path)
+            metrics.inc("gpt_cache_save_failures_total")
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path) as f:
+            entries = json.load(f)
+        now = time.time()
+        with self._lock:
+            for key, expires, content in entries[-self.max_entries:]:
+                if expires > now:
+                    self._entries[key] = (expires, content)
+        return self
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    # One cache per process, loaded from disk on first use
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache().load()
+            atexit.register(_cache.save)
+        return _cache
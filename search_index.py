@@ -0,0 +1,206 @@
+import datetime
+import json
+import os
+import re
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+
+import metrics
+
+INDEX_PATH = os.environ.get("IGNITEME_INDEX_PATH", ".cache/search_index")
+DIM = 256
+SAVE_EVERY = 50  # adds between saves to disk
+
+_WORD = re.compile(r"[a-z0-9']+")
+_STOPWORDS = {"a", "an", "and", "are", "at", "be", "but", "by", "for", "i", "i'm",
+              "in", "is", "it", "me", "my", "of", "on", "or", "so", "the", "to",
+              "want", "with"}
+
+
+def tokenize(text):
+    return [w for w in _WORD.findall(text.lower()) if w not in _STOPWORDS]
+
+
+def _features(tokens):
+    # Whole words plus a crude stem (the first five letters), so "exercise"
+    # and "exercising" still land close together
+    for word in tokens:
+        yield word, 1.0
+        if len(word) > 5:
+            yield word[:5] + "~", 0.7
+
+
+def _write_atomic(path, mode, write):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                               prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class SearchIndex:
+    # One row per post holding its goal and obstacle text: an inverted index
+    # of words for keyword search and a matrix of hashed feature vectors for
+    # cosine similarity, grown in place as posts are written
+    def __init__(self, dim=DIM):
+        self.dim = dim
+        self.vectors = np.zeros((64, dim), dtype=np.float32)
+        self.post_ids = []
+        self.rows = {}
+        self.texts = []
+        self.meta = []
+        self.postings = {}
+        self.synced_at = None
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def add(self, post_id, text, **meta):
+        # Adds a post, or appends more text (an obstacle) to one already indexed
+        with self._lock:
+            row = self.rows.get(post_id)
+            if row is None:
+                row = len(self.post_ids)
+                if row == len(self.vectors):
+                    self.vectors = np.concatenate(
+                        [self.vectors, np.zeros_like(self.vectors)])
+                self.rows[post_id] = row
+                self.post_ids.append(post_id)
+                self.texts.append(text)
+                self.meta.append(meta)
+            else:
+                self.texts[row] += "\n" + text
+                self.meta[row].update(meta)
+            tokens = tokenize(text)
+            for token in set(tokens):
+                self.postings.setdefault(token, set()).add(row)
+            self.vectors[row] = self._vectorize(tokenize(self.texts[row]))
+            self._unsaved += 1
+
+    def search(self, query, k=10):
+        # Keyword search: posts containing every query word, or any of them
+        # if none has all, ranked by similarity
+        tokens = tokenize(query)
+        with self._lock, metrics.timed("search_seconds", kind="keyword"):
+            sets = [self.postings.get(token, set()) for token in tokens]
+            rows = set.intersection(*sets) if sets else set()
+            if not rows and sets:
+                rows = set.union(*sets)
+            return self._rank(sorted(rows), tokens, k)
+
+    def similar(self, text, k=5, min_score=0.15, exclude=()):
+        # Nearest posts by cosine similarity over the whole index
+        with self._lock, metrics.timed("search_seconds", kind="similar"):
+            results = self._rank(None, tokenize(text), k + len(exclude))
+        return [r for r in results
+                if r["score"] >= min_score and r["id"] not in exclude][:k]
+
+    def _rank(self, rows, tokens, k):
+        # rows=None scores every post against a view of the matrix, no copy
+        if rows is None:
+            rows = np.arange(len(self.post_ids))
+            matrix = self.vectors[:len(rows)]
+        else:
+            rows = np.fromiter(rows, dtype=np.int64)
+            matrix = self.vectors[rows]
+        if not len(rows) or not tokens:
+            return []
+        scores = matrix @ self._vectorize(tokens)
+        top = np.argsort(-scores)[:k] if len(rows) <= k else \
+            np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [dict(self.meta[rows[i]], id=self.post_ids[rows[i]],
+                     score=float(scores[i])) for i in top]
+
+    def _vectorize(self, tokens):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in _features(tokens):
+            # Signed feature hashing, so collisions cancel out on average
+            h = zlib.crc32(feature.encode())
+            vector[h % self.dim] += weight if h & 0x80000000 else -weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def save(self, path=INDEX_PATH):
+        with self._lock:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            n = len(self.post_ids)
+            # Each file goes to a temp name of its own and replaces the old
+            # one whole; vectors first, so the ids never point past them
+            _write_atomic(f"{path}.npy", "wb", lambda f: np.save(f, self.vectors[:n]))
+            state = {"dim": self.dim, "post_ids": self.post_ids, "texts": self.texts,
+                     "meta": self.meta,
+                     "postings": {t: sorted(rows) for t, rows in self.postings.items()},
+                     "synced_at": self.synced_at.isoformat() if self.synced_at else None}
+            _write_atomic(f"{path}.json", "w", lambda f: json.dump(state, f))
+            self._unsaved = 0
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        if not os.path.exists(f"{path}.json"):
+            return cls()
+        with open(f"{path}.json") as f:
+            state = json.load(f)
+        index = cls(state["dim"])
+        # Saved before the ids, so a concurrent save may have added rows
+        vectors = np.load(f"{path}.npy")[:len(state["post_ids"])]
+        index.vectors = np.zeros((max(64, 2 * len(vectors)), index.dim), dtype=np.float32)
+        index.vectors[:len(vectors)] = vectors
+        index.post_ids = state["post_ids"]
+        index.rows = {post_id: row for row, post_id in enumerate(index.post_ids)}
+        index.texts = state["texts"]
+        index.meta = state["meta"]
+        index.postings = {t: set(rows) for t, rows in state["postings"].items()}
+        if state["synced_at"]:
+            index.synced_at = datetime.datetime.fromisoformat(state["synced_at"])
+        return index
+
+    def maybe_save(self, path=INDEX_PATH):
+        if self._unsaved >= SAVE_EVERY:
+            self.save(path)
+
+    def sync(self, db, path=INDEX_PATH):
+        # Full build on an empty index, otherwise only posts written since
+        # the last sync (posts carry created_at since this index was added)
+        synced_at = datetime.datetime.now(datetime.timezone.utc)
+        posts = db.collection("posts")
+        if self.synced_at is not None:
+            posts = posts.where("created_at", ">", self.synced_at)
+        new_ids = set()
+        for doc in posts.stream():
+            if doc.id in self.rows:
+                continue  # already added when its write committed
+            post = doc.to_dict()
+            new_ids.add(doc.id)
+            self.add(doc.id, post.get("content", ""), **_card(post))
+
+        if self.synced_at is None:
+            obstacles = db.collection_group("obstacles").stream()
+        else:
+            obstacles = (doc for post_id in new_ids for doc in
+                         db.collection(f"posts/{post_id}/obstacles").stream())
+        for doc in obstacles:
+            post_id = doc.reference.parent.parent.id
+            if post_id in new_ids:
+                self.add(post_id, doc.to_dict().get("content", ""))
+        self.synced_at = synced_at
+        self.save(path)
+
+
+def _card(post):
+    # Just enough of the post to show it as a search result
+    user_info = post.get("user_info") or {}
+    name = user_info.get("display_name") or user_info.get("user_name", "")
+    card = {"content": post.get("content", ""), "display_name": name}
+    if post.get("author"):
+        card["author"] = post["author"]
+    return card
@@ -1,12 +1,10 @@
 import argparse
-import json
 import streamlit as st
+from http_client import identity_toolkit_url, post_json
 from pprint import pprint
 
-import requests
 
-FIREBASE_WEB_API_KEY = st.secrets["FIREBASE_WEB_API_KEY"]
-rest_api_url = "https://identitytoolkit.googleapis.com/v1/accounts:sendOobCode"
+rest_api_url = identity_toolkit_url("accounts:sendOobCode")
 
 
 def get_id_token_arg():
@@ -20,14 +18,13 @@ def get_id_token_arg():
 
 
 def send_email_verification_link(id_token: str):
-    payload = json.dumps({
+    payload = {
         "requestType": "VERIFY_EMAIL",
         "idToken": id_token
-    })
+    }
 
-    r = requests.post(rest_api_url,
-                      params={"key": FIREBASE_WEB_API_KEY},
-                      data=payload)
+    r = post_json(rest_api_url, payload,
+                  params={"key": st.secrets["FIREBASE_WEB_API_KEY"]})
 
     return r.json()
 
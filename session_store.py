@@ -0,0 +1,127 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# Key/value store for per-browser state that has to outlive one Streamlit
+# process: auth tokens and the coaching dialog. Values are JSON, stored
+# zlib-compressed. Pick a backend with IGNITEME_SESSION_STORE:
+#   memory (default)        this process only
+#   sqlite:///path/to.db    every worker on one host
+#   redis://host:6379/0     every replica, needs the redis package
+
+SESSION_STORE = os.environ.get("IGNITEME_SESSION_STORE", "memory")
+
+
+def _dumps(value):
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+
+
+def _loads(blob):
+    return json.loads(zlib.decompress(blob))
+
+
+class MemoryStore:
+    def __init__(self):
+        self._values = {}  # key -> (expires or None, blob)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                del self._values[key]
+                return None
+        return _loads(entry[1])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._values[key] = (expires, _dumps(value))
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class SQLiteStore:
+    # WAL mode, so workers read while another one writes
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False,
+                                     isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sessions "
+                               "(key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM sessions WHERE key = ?", (key, )).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return _loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (key, value, expires) VALUES (?, ?, ?)",
+                (key, _dumps(value), expires))
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE key = ?", (key, ))
+
+    def purge(self):
+        # Expired rows are only skipped on read; call this now and then
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM sessions WHERE expires < ?", (time.time(), )).rowcount
+
+
+class RedisStore:
+    def __init__(self, url):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        blob = self._redis.get(key)
+        return None if blob is None else _loads(blob)
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, _dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+
+def open_store(url=SESSION_STORE):
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    raise ValueError(f"Unknown session store {url!r}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    # One store per process, shared by every session
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = open_store()
+        return _store
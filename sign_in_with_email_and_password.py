@@ -1,12 +1,10 @@
 import argparse
-import json
 import streamlit as st
-import requests
+from http_client import identity_toolkit_url, post_json
 import pprint
 
 
-FIREBASE_WEB_API_KEY = st.secrets["FIREBASE_WEB_API_KEY"]
-rest_api_url = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword"
+rest_api_url = identity_toolkit_url("accounts:signInWithPassword")
 
 
 def get_args():
@@ -22,15 +20,14 @@ def get_args():
 
 
 def sign_in_with_email_and_password(email: str, password: str, return_secure_token: bool = True):
-    payload = json.dumps({
+    payload = {
         "email": email,
         "password": password,
         "returnSecureToken": return_secure_token
-    })
+    }
 
-    r = requests.post(rest_api_url,
-                      params={"key": FIREBASE_WEB_API_KEY},
-                      data=payload)
+    r = post_json(rest_api_url, payload,
+                  params={"key": st.secrets["FIREBASE_WEB_API_KEY"]})
 
     return r.json()
 
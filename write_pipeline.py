@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class WritePipeline:
+    # Commits Firestore writes on a background pool so the script thread can
+    # return to the user straight away. Each logical write gets its own batch.
+    def __init__(self, db, max_workers=4, max_acks=10000):
+        self.db = db
+        self.max_acks = max_acks
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="firestore-write")
+        self._lock = threading.Lock()
+        self._acks = OrderedDict()
+
+    def submit(self, writes, on_commit=None, kind="write"):
+        # writes is a list of (document reference, data) or (reference, data,
+        # merge) set in one batch, kind labels its metrics
+        write_id = uuid.uuid4().hex
+        with self._lock:
+            self._acks[write_id] = {"status": "pending"}
+            while len(self._acks) > self.max_acks:
+                self._acks.popitem(last=False)
+        metrics.inc("firestore_writes_submitted_total", kind=kind)
+        self._executor.submit(self._commit, write_id, writes, on_commit, kind)
+        return write_id
+
+    def status(self, write_id):
+        with self._lock:
+            return dict(self._acks.get(write_id, {"status": "unknown"}))
+
+    def collect(self, write_ids):
+        # Pops and returns the acks of every finished write in write_ids
+        done = {}
+        with self._lock:
+            for write_id in write_ids:
+                ack = self._acks.get(write_id)
+                if ack is not None and ack["status"] != "pending":
+                    done[write_id] = self._acks.pop(write_id)
+        return done
+
+    def _commit(self, write_id, writes, on_commit, kind):
+        start = time.perf_counter()
+        try:
+            batch = self.db.batch()
+            for doc_ref, data, *merge in writes:
+                batch.set(doc_ref, data, merge=bool(merge and merge[0]))
+            batch.commit()
+        except Exception as e:
+            log.exception("%s write %s failed", kind, write_id)
+            ack = {"status": "failed", "error": str(e)}
+        else:
+            ack = {"status": "committed"}
+        seconds = time.perf_counter() - start
+        ack["seconds"] = seconds
+
+        with self._lock:
+            if write_id in self._acks:
+                self._acks[write_id] = ack
+        metrics.observe("firestore_commit_seconds", seconds, kind=kind)
+        metrics.inc("firestore_commits_total", kind=kind, status=ack["status"])
+        if ack["status"] == "committed":
+            metrics.inc("firestore_documents_written_total", len(writes), kind=kind)
+            if on_commit is not None:
+                # The write itself is done, so its ack stays committed
+                try:
+                    on_commit()
+                except Exception:
+                    log.exception("on_commit of %s write %s failed", kind, write_id)
+                    metrics.inc("firestore_on_commit_failures_total", kind=kind)